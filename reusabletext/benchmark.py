@@ -0,0 +1,296 @@
+import parse
+import ctprep
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import codecs
+import resource
+import subprocess
+import multiprocessing
+
+sectionMarks = '=-~^+'
+words = ('probability', 'hidden', 'variable', 'sum', 'model', 'prior',
+         'likelihood', 'posterior', 'sample', 'observation', 'the', 'a',
+         'of', 'we', 'can', 'compute', 'every', 'value', 'data', 'term')
+
+formatsText = r'''Formats
+-------
+
+:format: q
+  {{ this.title[0] + '\n' + '-' * len(this.title[0]) }}
+
+  {{ '\n'.join(this.text) }}
+
+  {% for clines in getattr(this, 'multichoice', [[]])[0] %}
+  {{ indented('#. ', clines) -}}
+  {% endfor %}
+
+  {% for answer in getattr(this, 'answer', ()) %}
+  {{ indented('   ', ['**Answer**:', ''] + answer) }}
+  {% endfor %}
+
+:format: list
+  {% for s in sources %}
+  * {{ s.tokens[1] }}
+  {% endfor %}
+'''
+
+# default synthetic corpus parameters
+corpusParams = dict(nfiles=20, nsections=10, depth=2, nesting=2,
+                    glossarySize=5, metadataDensity=0.5, fanout=50, seed=1)
+
+class CorpusWriter(object):
+    'generate random RUsT text with controllable structure'
+    def __init__(self, nfiles=20, nsections=10, depth=2, nesting=2,
+                 glossarySize=5, metadataDensity=0.5, fanout=50, seed=1):
+        self.nfiles = nfiles
+        self.nsections = nsections
+        self.depth = depth
+        self.nesting = nesting
+        self.glossarySize = glossarySize
+        self.metadataDensity = metadataDensity
+        self.fanout = fanout
+        self.random = random.Random(seed)
+        self.questionIDs = []
+    def paragraph(self, indent='', nlines=3):
+        l = []
+        for i in range(nlines):
+            l.append(indent + ' '.join([self.random.choice(words)
+                                        for j in range(10)]))
+        return l + ['']
+    def metadata(self, indent=''):
+        l = []
+        for tag in ('tests', 'proves', 'author'):
+            if self.random.random() < self.metadataDensity:
+                l.append('%s:%s: concept_%d' % (indent, tag,
+                                                self.random.randint(1, 50)))
+        return l
+    def question(self, qID, level, indent):
+        sub = indent + '  '
+        l = ['%s:question: %s' % (indent, qID),
+             '%s:title: Question %s' % (sub, qID)] + self.metadata(sub)
+        l += self.paragraph(sub)
+        if self.random.random() < 0.5:
+            l += ['%s:multichoice:' % sub,
+                  '%s  * %s :correct:' % (sub, self.random.choice(words)),
+                  '%s  * %s' % (sub, self.random.choice(words)),
+                  '%s  * %s' % (sub, self.random.choice(words)), '']
+        l += ['%s:answer:' % sub] + self.paragraph(sub + '  ', 2)
+        l += ['%s:error:' % sub] + self.paragraph(sub + '  ', 1)
+        if level < self.nesting: # add a nested sub-question
+            l += self.question(qID + '_%d' % level, level + 1, sub)
+        return l
+    def section(self, sectionID, level):
+        title = 'Section %s' % sectionID
+        l = [title, sectionMarks[level] * len(title),
+             ':ID: %s' % sectionID]
+        if self.random.random() < self.metadataDensity:
+            l.append(':defines: concept_%s' % sectionID)
+        l += self.metadata() + [''] + self.paragraph()
+        if self.random.random() < self.metadataDensity:
+            l += [':informal-definition:'] + self.paragraph('  ', 2)
+        qID = 'q_' + sectionID
+        self.questionIDs.append(qID)
+        l += self.question(qID, 1, '')
+        if self.glossarySize:
+            l += ['.. glossary::', '']
+            for i in range(self.glossarySize):
+                l += ['   term_%s_%d' % (sectionID, i)]
+                l += self.paragraph('     ', 1)
+        if level + 1 < self.depth:
+            l += self.section(sectionID + '_1', level + 1)
+        return l
+    def file_text(self, i):
+        l = []
+        for j in range(self.nsections):
+            l += self.section('s%d_%d' % (i, j), 0)
+        return '\n'.join(l)
+    def select_text(self, srcdir='src'):
+        l = ['Lecture', '-------', '', 'Intro to lecture.', '',
+             '.. select:: ' + srcdir]
+        for i in range(self.fanout):
+            if i % 10 == 9: # select a list of questions
+                ids = self.random.sample(self.questionIDs,
+                                         min(3, len(self.questionIDs)))
+                l.append('   * [%s] format=list' % ','.join(ids))
+            else:
+                l.append('   * %s format=q'
+                         % self.random.choice(self.questionIDs))
+        return '\n'.join(l + [''])
+
+def make_corpus(corpusDir, **kwargs):
+    '''write synthetic corpus: src/*.rst sources, src/formats.rst,
+    select.rst with the select directive, and corpus.json params'''
+    params = corpusParams.copy()
+    params.update(kwargs)
+    writer = CorpusWriter(**params)
+    srcdir = os.path.join(corpusDir, 'src')
+    parse.mkdir_if_needed(srcdir)
+    for i in range(writer.nfiles):
+        with open(os.path.join(srcdir, 'file%d.rst' % i), 'w') as ofile:
+            ofile.write(writer.file_text(i))
+    with open(os.path.join(srcdir, 'formats.rst'), 'w') as ofile:
+        ofile.write(formatsText)
+    with open(os.path.join(corpusDir, 'select.rst'), 'w') as ofile:
+        ofile.write(writer.select_text())
+    with open(os.path.join(corpusDir, 'corpus.json'), 'w') as ofile:
+        json.dump(params, ofile)
+    return params
+
+def clear_caches():
+    'discard in-process and on-disk parse caches'
+    parse.selectIndexCache.clear()
+    shutil.rmtree(parse.parseCacheDir, ignore_errors=True)
+
+def read_sources():
+    'get list of (rawtext, path) for corpus source files'
+    l = []
+    for path in parse.find_source_files('src'):
+        with codecs.open(path, 'rU', encoding='utf-8') as ifile:
+            l.append((ifile.read().split('\n'), path))
+    return l
+
+# each setup function returns (func, reset), where func is timed and
+# reset (if not None) is called before each run
+def setup_parse_rust():
+    sources = read_sources()
+    def func():
+        for rawtext, path in sources:
+            parse.parse_rust(rawtext, path)
+    return func, None
+
+def setup_index_rust():
+    tree = parse.parse_files(parse.find_source_files('src'), cacheDir=None)
+    return lambda: parse.index_rust(tree), None
+
+def setup_process_select_cold():
+    return lambda: parse.process_select('select.rst'), clear_caches
+
+def setup_process_select_lazy():
+    parse.lazyParse = True # each benchmark runs in its own process
+    return lambda: parse.process_select('select.rst'), clear_caches
+
+def setup_process_select_warm():
+    clear_caches()
+    parse.process_select('select.rst') # fill the on-disk parse cache
+    return (lambda: parse.process_select('select.rst'),
+            parse.selectIndexCache.clear)
+
+def setup_process_select_hot():
+    parse.process_select('select.rst') # fill the in-process index cache
+    return lambda: parse.process_select('select.rst'), None
+
+def setup_get_text():
+    tree = parse.process_select('select.rst')
+    return lambda: parse.get_text(tree), None
+
+def setup_export_csv():
+    tree = parse.process_select('select.rst')
+    questions = ctprep.get_questions(tree)
+    return (lambda: ctprep.save_question_csv(questions, 'benchmark.csv',
+                                             parse.PostprocDict)), None
+
+def setup_export_json():
+    tree = parse.process_select('select.rst')
+    def func():
+        data = tree.list_repr(textFunc=ctprep.flag_rst_images,
+                              postprocDict=parse.PostprocDict)
+        with codecs.open('benchmark.json', 'w', encoding='utf-8') as ofile:
+            json.dump(data, ofile)
+    return func, None
+
+benchmarks = (('parse_rust', setup_parse_rust),
+              ('index_rust', setup_index_rust),
+              ('process_select_cold', setup_process_select_cold),
+              ('process_select_lazy', setup_process_select_lazy),
+              ('process_select_warm', setup_process_select_warm),
+              ('process_select_hot', setup_process_select_hot),
+              ('get_text', setup_get_text),
+              ('export_csv', setup_export_csv),
+              ('export_json', setup_export_json))
+
+def run_benchmark(args):
+    '''time one benchmark in this (fresh) process, reporting peak
+    memory (maxrss, in KB on Linux) after setup and after the runs'''
+    name, corpusDir, repeat = args
+    os.chdir(corpusDir)
+    func, reset = dict(benchmarks)[name]()
+    setupRSS = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    times = []
+    for i in range(repeat):
+        if reset:
+            reset()
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    if reset:
+        reset()
+    return dict(name=name, times=times, min=min(times),
+                mean=sum(times) / len(times), setupMaxRSS=setupRSS,
+                maxRSS=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+def get_commit():
+    'current git commit of this package, or None'
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmarks(corpusDir, names=None, repeat=5):
+    'run benchmarks, each in a fresh process, return results dict'
+    corpusDir = os.path.abspath(corpusDir)
+    if not names:
+        names = [t[0] for t in benchmarks]
+    results = []
+    for name in names:
+        pool = multiprocessing.Pool(1) # fresh process measures its own RSS
+        try:
+            results.append(pool.apply(run_benchmark,
+                                      ((name, corpusDir, repeat),)))
+        finally:
+            pool.close()
+            pool.join()
+        print '%s: %.4f s (min of %d)' % (name, results[-1]['min'], repeat)
+    with open(os.path.join(corpusDir, 'corpus.json')) as ifile:
+        corpus = json.load(ifile)
+    return dict(commit=get_commit(), python=sys.version, corpus=corpus,
+                repeat=repeat, results=results)
+
+def compare_results(oldfile, newfile):
+    'print timing and memory ratios new / old for each benchmark'
+    with open(oldfile) as ifile:
+        old = json.load(ifile)
+    with open(newfile) as ifile:
+        new = json.load(ifile)
+    oldResults = dict((d['name'], d) for d in old['results'])
+    for d in new['results']:
+        try:
+            o = oldResults[d['name']]
+        except KeyError:
+            continue
+        print '%-22s time %.3fx  maxRSS %.3fx' \
+              % (d['name'], d['min'] / o['min'],
+                 float(d['maxRSS']) / o['maxRSS'])
+
+if __name__ == '__main__':
+    cmd, args = (sys.argv[1:2] or [None])[0], sys.argv[2:]
+    if cmd == 'make' and args: # make CORPUSDIR [param=value ...]
+        params = dict([s.split('=') for s in args[1:]])
+        for k, v in params.items():
+            params[k] = type(corpusParams[k])(v)
+        make_corpus(args[0], **params)
+    elif cmd == 'run' and len(args) >= 2: # run CORPUSDIR OUTFILE [name ...]
+        results = run_benchmarks(args[0], args[2:])
+        with open(args[1], 'w') as ofile:
+            json.dump(results, ofile, indent=1)
+    elif cmd == 'compare' and len(args) == 2: # compare OLDFILE NEWFILE
+        compare_results(*args)
+    else:
+        print '''usage: %s make CORPUSDIR [nfiles=20 nsections=10 depth=2 ...]
+       %s run CORPUSDIR OUTFILE [BENCHMARK ...]
+       %s compare OLDFILE NEWFILE''' % ((sys.argv[0],) * 3)
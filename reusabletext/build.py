@@ -0,0 +1,441 @@
+import parse
+import ctprep
+import os
+import sys
+import json
+import time
+import codecs
+import traceback
+import multiprocessing
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+# saved {outfile:{input:stamp}} of the last build of each output
+buildStateFile = '_rust_build.json'
+
+# directory to copy the images of .csv outputs to, like ctprep's IMAGEDIR
+imagePath = None
+
+def get_local_node(path):
+    'get (node, kind) for a local source path'
+    path = os.path.abspath(path)
+    if os.path.isdir(path):
+        return path, 'dir'
+    if os.path.isfile(path) and not path.lower().endswith('.rst'):
+        return path, 'file' # :fileselect: source
+    return path, 'rst'
+
+def get_source_node(srcpath, filepath):
+    'get (node, kind) for a .. select:: source, as parse_select() reads it'
+    if srcpath.startswith('sqlite:'):
+        return (os.path.abspath(parse.expand_path(srcpath[7:], filepath)),
+                'sqlite')
+    if parse.is_url(srcpath):
+        return srcpath, 'url'
+    if srcpath.startswith('mongodb:'):
+        return srcpath, 'mongodb'
+    return get_local_node(parse.expand_path(srcpath, filepath))
+
+class BuildGraph(object):
+    '''graph of select files -> source paths -> source files, found by
+    scanning their .. select:: lines without parsing them.  Nodes are
+    absolute paths, URLs or mongodb: sources'''
+    def __init__(self):
+        self.deps = {} # {node:[nodes it depends on]}
+        self.kinds = {} # {node:kind}
+        self.blocked = set() # nodes found to depend on themselves
+    def add(self, node, kind='rst'):
+        'add node and, recursively, everything it depends on'
+        stack = [(node, kind)]
+        while stack:
+            node, kind = stack.pop()
+            if node in self.kinds:
+                continue
+            self.kinds[node] = kind
+            deps = []
+            if kind == 'rst' and os.path.isfile(node):
+                for srcpath in parse.get_select_paths(node):
+                    deps.append(get_source_node(srcpath, node))
+            elif kind == 'dir':
+                deps = [get_local_node(path)
+                        for path in parse.find_source_files(node)]
+            elif kind == 'url': # its downloaded copy, if any
+                path = parse.get_download_path(node, parse.downloadCacheDir)
+                if os.path.isfile(path):
+                    deps.append(get_local_node(path))
+            self.deps[node] = [t[0] for t in deps]
+            stack += deps
+    def toposort(self, roots):
+        '''list of nodes reachable from roots, each after the nodes it
+        depends on; dependency cycles are reported and cut'''
+        order = []
+        done = {} # {node:False while visiting, True when finished}
+        for root in roots:
+            if root in done:
+                continue
+            done[root] = False
+            stack = [(root, iter(self.deps[root]))]
+            while stack:
+                node, deps = stack[-1]
+                for dep in deps:
+                    if dep not in done:
+                        done[dep] = False
+                        stack.append((dep, iter(self.deps[dep])))
+                        break
+                    elif not done[dep] and dep not in self.blocked:
+                        print 'WARNING: infinite .. select:: loop blocked:', \
+                              dep
+                        self.blocked.add(dep)
+                else: # all its dependencies are done
+                    stack.pop()
+                    done[node] = True
+                    order.append(node)
+        return order
+    def refresh(self, nodes):
+        're-scan nodes (e.g. files that changed) for their dependencies'
+        for node in nodes:
+            kind = self.kinds.pop(node, None)
+            if kind is not None:
+                del self.deps[node]
+                self.add(node, kind)
+    def get_stamp(self, node):
+        'stamp for detecting changes to node, or None if not trackable'
+        kind = self.kinds[node]
+        if kind == 'mongodb': # cannot tell, so assume always changed
+            return None
+        if kind in ('dir', 'url'): # changes show up in its deps
+            return [kind]
+        try:
+            st = os.stat(node)
+        except OSError:
+            return ['missing']
+        return [st.st_mtime, st.st_size]
+    def get_inputs(self, root):
+        'get {node:stamp} for everything that root depends on, and root'
+        return dict([(node, self.get_stamp(node))
+                     for node in self.toposort([root])])
+
+def plan_graph(selectFiles):
+    '''get BuildGraph of selectFiles, after fetching their http(s)
+    sources so that the graph includes the downloaded files.
+    Each URL is revalidated once, here, for the whole build run'''
+    parse.validatedURLs.clear()
+    graph = BuildGraph()
+    for path in selectFiles:
+        graph.add(path)
+    urls = [node for node in graph.toposort(selectFiles)
+            if graph.kinds[node] == 'url']
+    parse.run_threads(lambda url: parse.download_file(url,
+                                                      parse.downloadCacheDir),
+                      urls, parse.downloadWorkers)
+    if [url for url in urls if not graph.deps[url]]: # new downloads
+        graph = BuildGraph()
+        for path in selectFiles:
+            graph.add(path)
+    return graph
+
+def warm_parse_cache(path):
+    'process pool worker: parse path just to save its parse cache'
+    parse.parse_file(path)
+
+def resolve_sources(graph, order, workers=None):
+    '''convert, parse and index the sources in toposort() order, so
+    that parsing the select files finds them all in caches.  Files
+    with no .. select:: are parsed by up to workers processes'''
+    kinds = graph.kinds
+    pdfSources = [node for node in order if kinds[node] == 'file'
+                  and not node.lower().endswith('.pdf')]
+    parse.run_threads(lambda path: parse.convert_to_pdf(path,
+                                                        parse.pdfCacheDir,
+                                                        parse.convertCmd),
+                      pdfSources, parse.convertWorkers)
+    leaves = [node for node in order if kinds[node] == 'rst'
+              and not graph.deps[node] and os.path.isfile(node)]
+    if workers and parse.parseCacheDir and len(leaves) > 1:
+        pool = multiprocessing.Pool(workers)
+        try:
+            pool.map(warm_parse_cache, leaves)
+        finally:
+            pool.close()
+            pool.join()
+    index_sources(graph, order)
+
+def index_sources(graph, order):
+    '''update the select index of each source path in toposort()
+    order, i.e. before the files that select from it'''
+    kinds = graph.kinds
+    selected = set() # source paths named by .. select:: directives
+    for node in order:
+        if kinds[node] in ('rst', 'url'):
+            selected.update(graph.deps[node])
+    for node in order:
+        if node in selected and kinds[node] in ('rst', 'dir') \
+           and os.path.exists(node):
+            parse.load_source_path(node)
+
+def load_state(path=buildStateFile):
+    try:
+        with open(path) as ifile:
+            return json.load(ifile)
+    except (IOError, ValueError):
+        return {}
+
+def save_state(state, path=buildStateFile):
+    with open(path, 'w') as ofile:
+        json.dump(state, ofile)
+
+def is_stale(outfile, inputs, state):
+    'True if outfile is missing or any of its inputs changed'
+    if not os.path.isfile(outfile) or None in inputs.values():
+        return True
+    return state.get(outfile) != inputs
+
+def build(targets, workers=None, statePath=buildStateFile):
+    '''write process_select() output of each (selectFile, outfile) in
+    targets, unless nothing it depends on has changed since its last
+    build.  Returns list of the outfiles rebuilt'''
+    targets = [(os.path.abspath(selectFile), os.path.abspath(outfile))
+               for selectFile, outfile in targets]
+    graph = plan_graph([t[0] for t in targets])
+    state = load_state(statePath)
+    stale = []
+    for selectFile, outfile in targets:
+        inputs = graph.get_inputs(selectFile)
+        if is_stale(outfile, inputs, state):
+            stale.append((selectFile, outfile, inputs))
+    if not stale:
+        return []
+    resolve_sources(graph, graph.toposort([t[0] for t in stale]), workers)
+    for selectFile, outfile, inputs in stale:
+        tree = parse.process_select(selectFile, revalidate=False)
+        write_output(tree, outfile, {})
+        state[outfile] = inputs
+        save_state(state, statePath) # record each output as it is done
+    return [t[1] for t in stale]
+
+# seconds between polls of source file stamps, if not using inotify
+pollInterval = 0.2
+
+class PollWaiter(object):
+    'wait for changes by just sleeping until the next poll'
+    def __init__(self, interval=None):
+        self.interval = interval or pollInterval
+    def set_paths(self, paths):
+        pass
+    def wait(self):
+        time.sleep(self.interval)
+
+class InotifyWaiter(object):
+    '''wait until inotify reports a change in a directory containing
+    one of the watched paths (or until timeout seconds pass)'''
+    mask = 0
+    if pyinotify is not None:
+        mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO \
+               | pyinotify.IN_MOVED_FROM | pyinotify.IN_CREATE \
+               | pyinotify.IN_DELETE | pyinotify.IN_ATTRIB
+    def __init__(self, timeout=1.):
+        self.manager = pyinotify.WatchManager()
+        self.notifier = pyinotify.Notifier(self.manager, lambda event: None,
+                                           timeout=int(timeout * 1000))
+        self.dirs = {} # {dirpath:watch descriptor}
+    def set_paths(self, paths):
+        dirs = set()
+        for path in paths:
+            if os.path.isdir(path):
+                dirs.add(path)
+            else:
+                dirs.add(os.path.dirname(path))
+        for dirpath in dirs.difference(self.dirs):
+            if os.path.isdir(dirpath):
+                wd = self.manager.add_watch(dirpath, self.mask)[dirpath]
+                if wd >= 0:
+                    self.dirs[dirpath] = wd
+        for dirpath in set(self.dirs).difference(dirs):
+            self.manager.rm_watch(self.dirs.pop(dirpath))
+    def wait(self):
+        if self.notifier.check_events():
+            self.notifier.read_events()
+            self.notifier.process_events()
+
+def get_waiter():
+    'inotify waiter where available, else poll'
+    if pyinotify is not None:
+        return InotifyWaiter()
+    return PollWaiter()
+
+class CachingRenderer(parse.TextRenderer):
+    '''TextRenderer that reuses the text rendered for a :select: node
+    by the previous build, if none of its inputs have changed.  Source
+    nodes and templates are compared by identity, since RustIndex only
+    replaces the nodes of files it re-parses'''
+    def __init__(self, postprocDict, cache, **kwargs):
+        parse.TextRenderer.__init__(self, postprocDict, **kwargs)
+        self.oldCache = cache
+        self.cache = {} # {key:(node, template, text)} used by this build
+        self.nrendered = 0
+        self.nselect = 0
+    def get_key(self, node):
+        'get (key, template); key holds ids of objects that node keeps'
+        params = []
+        for k, v in sorted(node.selectParams.items()):
+            if isinstance(v, list): # list of source nodes
+                v = tuple([id(c) for c in v])
+            elif not isinstance(v, basestring): # source node
+                v = id(v)
+            params.append((k, v))
+        try:
+            template = node.formatDict[node.selectParams['format']]
+        except (KeyError, AttributeError):
+            template = None
+        key = (id(template), tuple(node.tokens), tuple(params),
+               id(getattr(node, '_text', None)),
+               tuple([id(c) for c in node.children]),
+               tuple([id(m) for m in getattr(node, 'metadata', ())]),
+               id(getattr(node, 'title', None)))
+        return key, template
+    def get_text_select(self, node):
+        key, template = self.get_key(node)
+        try:
+            text = self.oldCache[key][2]
+        except KeyError:
+            text = parse.TextRenderer.get_text_select(self, node)
+            self.nrendered += 1
+        self.cache[key] = (node, template, text) # keep ids in key valid
+        self.nselect += 1
+        return text
+
+def write_output(tree, outfile, renderCache):
+    '''write tree to outfile as reST, or as ctprep CSV or ORCT JSON
+    if outfile ends with .csv or .json.  For reST, saves the :select:
+    text in renderCache[outfile] for reuse, and returns the number of
+    :select: nodes (rendered, total)'''
+    kind = os.path.splitext(outfile)[1].lower()[1:]
+    if kind in ('csv', 'json'): # same output as ctprep.py would write
+        output = ctprep.get_outputs(outfile, imagePath, (kind,),
+                                    ctprep.defaultErrorModels,
+                                    {kind:outfile})[0]
+        return output.write(tree)
+    renderer = CachingRenderer(parse.PostprocDict,
+                               renderCache.get(outfile, {}))
+    with codecs.open(outfile, 'w', encoding='utf-8') as ofile:
+        parse.write_lines(renderer.iter_text(tree), ofile)
+    renderCache[outfile] = renderer.cache
+    return renderer.nrendered, renderer.nselect
+
+class Watcher(object):
+    '''keeps the select indexes and rendered text of its targets in
+    memory, and after each change to their inputs re-parses only the
+    changed files and rebuilds only the outputs that depend on them'''
+    def __init__(self, targets, waiter=None):
+        self.selectFiles = []
+        self.outputs = {} # {selectFile:[outfile,...]}
+        for selectFile, outfile in targets:
+            selectFile = os.path.abspath(selectFile)
+            if selectFile not in self.outputs:
+                self.selectFiles.append(selectFile)
+                self.outputs[selectFile] = []
+            self.outputs[selectFile].append(os.path.abspath(outfile))
+        if waiter is None:
+            waiter = get_waiter()
+        self.waiter = waiter
+        self.renderCache = {} # {outfile:CachingRenderer.cache}
+        self.graph = plan_graph(self.selectFiles)
+        self.update_order()
+        resolve_sources(self.graph, self.order, parse.parseWorkers)
+        self.stamps = self.get_stamps()
+    def update_order(self):
+        self.order = self.graph.toposort(self.selectFiles)
+        kinds = self.graph.kinds
+        n = len([node for node in self.order if kinds[node] in ('rst', 'dir')])
+        if parse.selectIndexCache.maxsize < n: # keep all indexes in memory
+            parse.selectIndexCache.maxsize = n
+        self.waiter.set_paths([node for node in self.order
+                               if kinds[node] not in ('url', 'mongodb')])
+    def get_stamps(self):
+        '''get {node:stamp} of local inputs; a directory is stamped by
+        its list of source files'''
+        stamps = {}
+        for node in self.order:
+            kind = self.graph.kinds[node]
+            if kind == 'dir':
+                stamps[node] = parse.find_source_files(node)
+            elif kind not in ('url', 'mongodb'):
+                stamps[node] = self.graph.get_stamp(node)
+        return stamps
+    def check(self):
+        'rebuild outputs if their inputs changed; return list rebuilt'
+        stamps = self.get_stamps()
+        changed = set([node for node, stamp in stamps.items()
+                       if self.stamps.get(node) != stamp])
+        if not changed:
+            return []
+        self.graph.refresh([node for node in changed
+                            if self.graph.kinds[node] in ('rst', 'dir')])
+        self.update_order()
+        self.stamps = self.get_stamps() # including any new nodes
+        for node, stamp in stamps.items(): # so later edits are not missed
+            if node in self.stamps:
+                self.stamps[node] = stamp
+        return self.rebuild(changed)
+    def rebuild(self, changed=None):
+        '''re-index changed sources and write the outputs that depend
+        on them (all outputs if changed is None); return list of them'''
+        start = time.time()
+        index_sources(self.graph, self.order)
+        rebuilt = []
+        for selectFile in self.selectFiles:
+            if changed is not None and \
+               not changed.intersection(self.graph.toposort([selectFile])):
+                continue
+            tree = parse.parse_file(selectFile)
+            parse.apply_select(tree)
+            for outfile in self.outputs[selectFile]:
+                counts = write_output(tree, outfile, self.renderCache)
+                if counts: # else the output printed its own message
+                    print 'wrote %s (rendered %d of %d selections)' \
+                          % (outfile, counts[0], counts[1])
+                rebuilt.append(outfile)
+        print 'rebuilt in %.3f s' % (time.time() - start)
+        return rebuilt
+    def run(self):
+        'build all outputs, then rebuild them as needed until interrupted'
+        self.rebuild()
+        while True:
+            self.waiter.wait()
+            try:
+                self.check()
+            except KeyboardInterrupt:
+                raise
+            except Exception: # report the error, wait for the next change
+                traceback.print_exc()
+
+def watch(targets, waiter=None):
+    'keep (selectFile, outfile) targets up to date until interrupted'
+    try:
+        Watcher(targets, waiter).run()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    watchMode = args[:1] == ['--watch']
+    if watchMode:
+        args = args[1:]
+    if args[:1] == ['--images'] and len(args) > 1:
+        imagePath = args[1]
+        args = args[2:]
+    if not args or len(args) % 2:
+        print 'usage: %s [--watch] [--images IMAGEDIR] ' \
+              'INRSTFILE OUTFILE [INRSTFILE OUTFILE ...]' % sys.argv[0]
+    elif watchMode:
+        watch(zip(args[::2], args[1::2]))
+    else:
+        rebuilt = build(zip(args[::2], args[1::2]),
+                        workers=multiprocessing.cpu_count())
+        for outfile in rebuilt:
+            print 'wrote', outfile
+        if not rebuilt:
+            print 'all outputs are up to date'
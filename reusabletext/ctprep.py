@@ -6,6 +6,7 @@ import subprocess
 import warnings
 import os.path
 import codecs
+import json
 import re
 try:
     import pypandoc
@@ -15,17 +16,9 @@ except ImportError:
 def make_slides_and_csv(ctfile, imagepath, title='Concept Tests', 
                         globalErrors=()):
     'produces CSV for Socraticqs to load, and RST for rst2beamer to convert'
-    tree = parse.process_select(ctfile)
-    questions = get_questions(tree)
-    ctstem = ctfile.split('.')[0]
-    print 'writing', ctstem + '.csv'
-    save_question_csv(questions, ctstem + '.csv', parse.PostprocDict,
-                      imagepath, globalErrors=globalErrors)
-    rstout =  ctstem + '_slides.rst'
-    print 'writing', rstout
-    with codecs.open(rstout, 'w', encoding='utf-8') as ofile:
-        ofile.write(parse.get_text(tree))
-    return rstout, tree
+    outputs = get_outputs(ctfile, imagepath, ('csv', 'rst'), globalErrors)
+    tree = run_pipeline(ctfile, outputs)
+    return outputs[0].outfile, tree
 
 def make_tex(slidesfile, usePDFPages=False, beamerTheme=None, docTitle=None):
     'convert RST slides to TEX using rst2beamer'
@@ -284,6 +277,115 @@ def check_fileselect(tree):
         if getattr(node, 'tokens', ('ignore',))[0] == ':fileselect:':
             return True
 
+class RstOutput(object):
+    'reST text of the select tree, e.g. slides for rst2beamer'
+    requires = None
+    def __init__(self, outfile):
+        self.outfile = outfile
+    def write(self, tree):
+        print 'writing', self.outfile
+        with codecs.open(self.outfile, 'w', encoding='utf-8') as ofile:
+            parse.write_text(tree, ofile)
+
+class CsvOutput(object):
+    'Socraticqs CSV of the questions in the select tree'
+    requires = None
+    def __init__(self, outfile, imagepath=None, globalErrors=()):
+        self.outfile = outfile
+        self.imagepath = imagepath
+        self.globalErrors = globalErrors
+    def write(self, tree):
+        print 'writing', self.outfile
+        save_question_csv(get_questions(tree), self.outfile,
+                          parse.PostprocDict, self.imagepath,
+                          globalErrors=self.globalErrors)
+
+class JsonOutput(object):
+    'ORCT JSON of the select tree'
+    requires = None
+    def __init__(self, outfile):
+        self.outfile = outfile
+    def write(self, tree):
+        print 'writing', self.outfile
+        data = tree.list_repr(textFunc=flag_rst_images,
+                              postprocDict=parse.PostprocDict)
+        with codecs.open(self.outfile, 'w', encoding='utf-8') as ofile:
+            json.dump(data, ofile)
+
+class TexOutput(object):
+    'beamer latex converted from the slides of an RstOutput'
+    def __init__(self, rstOutput, beamerTheme=None, docTitle=None):
+        self.requires = rstOutput
+        self.outfile = rstOutput.outfile.split('.')[0] + '.tex'
+        self.beamerTheme = beamerTheme
+        self.docTitle = docTitle
+    def write(self, tree):
+        usePDFPages = check_fileselect(tree) # do we need pdfpages package?
+        make_tex(self.requires.outfile, usePDFPages, self.beamerTheme,
+                 self.docTitle)
+
+class PdfOutput(object):
+    'PDF compiled by pdflatex from a TexOutput'
+    def __init__(self, texOutput):
+        self.requires = texOutput
+        self.outfile = texOutput.outfile.split('.')[0] + '.pdf'
+    def write(self, tree):
+        print 'running pdflatex...'
+        subprocess.call(['pdflatex', self.requires.outfile])
+
+# output kinds of get_outputs(), in the order they are listed
+outputKinds = ('rst', 'csv', 'json', 'tex', 'pdf')
+
+def get_outputs(ctfile, imagepath=None, kinds=('rst', 'csv', 'tex', 'pdf'),
+                globalErrors=(), outfiles=None):
+    '''get list of outputs for select file ctfile, named after it as
+    ctprep.py always has (unless named in outfiles, a {kind:path}
+    dict), adding those that the kinds need'''
+    kinds = set(kinds)
+    if 'pdf' in kinds:
+        kinds.add('tex')
+    if 'tex' in kinds:
+        kinds.add('rst')
+    ctstem = ctfile.split('.')[0]
+    names = dict(rst=ctstem + '_slides.rst', csv=ctstem + '.csv',
+                 json=ctstem + '.json')
+    names.update(outfiles or {})
+    d = {}
+    if 'rst' in kinds:
+        d['rst'] = RstOutput(names['rst'])
+    if 'csv' in kinds:
+        d['csv'] = CsvOutput(names['csv'], imagepath, globalErrors)
+    if 'json' in kinds:
+        d['json'] = JsonOutput(names['json'])
+    if 'tex' in kinds:
+        d['tex'] = TexOutput(d['rst'])
+    if 'pdf' in kinds:
+        d['pdf'] = PdfOutput(d['tex'])
+    return [d[kind] for kind in outputKinds if kind in d]
+
+def write_outputs(tree, outputs, workers=None):
+    '''write the select tree to each of outputs, running up to workers
+    of them at once (which only pays off for outputs that wait on
+    external commands, e.g. pdflatex); an output is written after the
+    one it requires'''
+    done = set()
+    pending = list(outputs)
+    while pending:
+        ready = [output for output in pending
+                 if output.requires is None or output.requires in done]
+        if not ready:
+            raise ValueError('outputs require an output not in the list')
+        parse.run_threads(lambda output: output.write(tree), ready, workers)
+        done.update(ready)
+        pending = [output for output in pending if output not in done]
+
+def run_pipeline(ctfile, outputs, workers=None):
+    '''process the select file once, and write the resulting tree to
+    all the outputs; returns the tree'''
+    tree = parse.process_select(ctfile)
+    write_outputs(tree, outputs, workers)
+    return tree
+
 defaultErrorModels = (
     "some people misread the question (ABORT).",
     "some people didn't know a basic definition needed for this question (ABORT).",
@@ -295,12 +397,11 @@ defaultErrorModels = (
 if __name__ == '__main__':
     import sys
     try:
-        infile, imagepath = sys.argv[1:]
+        infile, imagepath = sys.argv[1:3]
     except ValueError:
-        print 'usage: %s INRSTFILE IMAGEDIR' % sys.argv[0]
-    rstout, tree = make_slides_and_csv(infile, imagepath, 
-                                       globalErrors=defaultErrorModels)
-    usePDFPages = check_fileselect(tree) # do we need pdfpages package?
-    texfile = make_tex(rstout, usePDFPages) # generate beamer latex
-    print 'running pdflatex...'
-    subprocess.call(['pdflatex', texfile])
+        print 'usage: %s INRSTFILE IMAGEDIR [rst|csv|json|tex|pdf ...]' \
+              % sys.argv[0]
+    else:
+        kinds = sys.argv[3:] or ('rst', 'csv', 'tex', 'pdf')
+        run_pipeline(infile, get_outputs(infile, imagepath, kinds,
+                                         globalErrors=defaultErrorModels))
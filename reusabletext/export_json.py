@@ -1,18 +1,10 @@
 import parse
 import ctprep
-import codecs
-import json
 
 def export_selected_orct(selectfile, globalErrors=()):
     'export JSON for ORCT in a lecture'
-    tree = parse.process_select(selectfile)
-    ctstem = selectfile.split('.')[0]
-    outfile = ctstem + '.json'
-    print 'writing', outfile
-    data = tree.list_repr(textFunc=ctprep.flag_rst_images,
-                            postprocDict=parse.PostprocDict)
-    with codecs.open(outfile, 'w', encoding='utf-8') as ofile:
-        json.dump(data, ofile)
+    ctprep.run_pipeline(selectfile, ctprep.get_outputs(selectfile,
+                                                       kinds=('json',)))
 
 
 ## def get_node_dict(node, textFunc=ctprep.flag_rst_images,
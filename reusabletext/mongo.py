@@ -1,11 +1,10 @@
 import pymongo
 import jsonpickle
 import json
+import hashlib
 import os.path
-try:
-    from jinja2 import Template
-except ImportError:
-    pass
+import parse
+from bson.binary import Binary
 
 def extract_docs(doc, level=1):
     'get list of top-level sections and questions, each as parse tree'
@@ -42,26 +41,42 @@ def combine_text(doc):
     
             
 
+def jsonize_doc(doc, pickler=None):
+    '''transform doc to JSON style dict that mongodb can save, with
+    a contentHash of its contents'''
+    if pickler is None:
+        pickler = jsonpickle.pickler.Pickler()
+    d = pickler.flatten(doc) # same dict as json.loads(jsonpickle.encode())
+    d['content'] = '\n'.join(combine_text(doc)) # searchable text string
+    try: # get title attr or metadata
+        d['title'] = '\n'.join(doc.title)
+    except AttributeError:
+        m = doc.metadata_dict().get('title', ())
+        if m:
+            d['title'] = '\n'.join(m)
+    d['contentHash'] = hashlib.sha1(json.dumps(d, sort_keys=True)).hexdigest()
+    d['rustTree'] = Binary(parse.encode_trees([doc])) # fast to decode
+    return d
+
 def jsonize_docs(docs):
     'transform docs to JSON style dicts that mongodb can save'
-    l = []
-    for doc in docs:
-        d = json.loads(jsonpickle.encode(doc)) # create a dictionary
-        d['content'] = '\n'.join(combine_text(doc)) # searchable text string
-        try: # get title attr or metadata
-            d['title'] = '\n'.join(doc.title)
-        except AttributeError:
-            m = []
-            for s in getattr(doc, 'metadata', ()):
-                if s.startswith(':title: '):
-                    m.append(s[8:])
-            if m:
-                d['title'] = '\n'.join(m)
-        l.append(d)
-    return l
+    pickler = jsonpickle.pickler.Pickler()
+    return [jsonize_doc(doc, pickler) for doc in docs]
+
+# {MongoClient kwargs:client}, so all collections share connection pools
+clients = {}
+
+def get_client(**kwargs):
+    'get shared MongoClient for these connection settings'
+    k = tuple(sorted(kwargs.items()))
+    try:
+        return clients[k]
+    except KeyError:
+        client = clients[k] = pymongo.MongoClient(**kwargs)
+        return client
 
 def init_collection(dbName='socraticqs', collName='latest', **kwargs):
-    client = pymongo.MongoClient(**kwargs)
+    client = get_client(**kwargs)
     db = client[dbName]
     db.drop_collection(collName)
     coll = db[collName]
@@ -70,7 +85,7 @@ def init_collection(dbName='socraticqs', collName='latest', **kwargs):
     return coll
 
 def get_collection(dbName='socraticqs', collName='latest', **kwargs):
-    client = pymongo.MongoClient(**kwargs)
+    client = get_client(**kwargs)
     db = client[dbName]
     coll = db[collName]
     return coll
@@ -89,6 +104,73 @@ def insert_formats(formatDict, coll=None, collName='formats', **kwargs):
     l = [dict(_id=t[0], template=t[1]) for t in formatDict.items()]
     coll.insert(l)
 
+def generate_batches(iterable, batchSize):
+    'split iterable into lists of up to batchSize items'
+    batch = []
+    for v in iterable:
+        batch.append(v)
+        if len(batch) >= batchSize:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def save_docs(docs, coll=None, batchSize=1000, **kwargs):
+    '''upsert docs by tokenID and contentHash in unordered bulk writes
+    of batchSize, skipping docs already saved unchanged, then delete
+    saved docs that are no longer in docs.  Identical docs (e.g. with
+    no tokenID) are told apart by their copyIndex, so each is kept.
+    Returns (number of docs written, number skipped, number deleted)'''
+    if coll is None:
+        coll = get_collection(**kwargs)
+    coll.create_index([('py/state.tokenID', 1), ('contentHash', 1),
+                       ('copyIndex', 1)])
+    saved = {} # {(tokenID, contentHash, copyIndex):[_id,...]}
+    for d in coll.find({}, {'py/state.tokenID':True, 'contentHash':True,
+                            'copyIndex':True}):
+        k = (d.get('py/state', {}).get('tokenID'), d.get('contentHash'),
+             d.get('copyIndex', 0))
+        saved.setdefault(k, []).append(d['_id'])
+    keys = set()
+    copies = {}
+    pickler = jsonpickle.pickler.Pickler()
+    def generate_ops():
+        for doc in docs:
+            d = jsonize_doc(doc, pickler)
+            k0 = (d['py/state'].get('tokenID'), d['contentHash'])
+            d['copyIndex'] = copies[k0] = copies.get(k0, -1) + 1
+            k = k0 + (d['copyIndex'],)
+            keys.add(k)
+            if k not in saved: # new or changed
+                yield pymongo.ReplaceOne({'py/state.tokenID':k[0],
+                                          'contentHash':k[1],
+                                          'copyIndex':k[2]}, d,
+                                         upsert=True)
+    n = 0
+    for batch in generate_batches(generate_ops(), batchSize):
+        coll.bulk_write(batch, ordered=False)
+        n += len(batch)
+    stale = [] # _ids of docs no longer in docs, or saved more than once
+    for k, ids in saved.items():
+        if k in keys:
+            stale += ids[1:]
+        else:
+            stale += ids
+    deleted = 0
+    for batch in generate_batches(stale, batchSize):
+        deleted += coll.delete_many({'_id':{'$in':batch}}).deleted_count
+    return n, len(keys) - n, deleted
+
+def save_formats(formatDict, coll=None, collName='formats', **kwargs):
+    'upsert formats in one bulk write, deleting any others'
+    if coll is None:
+        coll = get_collection(collName=collName, **kwargs)
+    ops = [pymongo.ReplaceOne({'_id':k}, dict(_id=k, template=v),
+                              upsert=True) for k, v in formatDict.items()]
+    if ops:
+        coll.bulk_write(ops, ordered=False)
+    coll.delete_many({'_id':{'$nin':formatDict.keys()}})
+
 def text_search(coll, query, limit=50):
     d = coll.database.command('text', coll.name, search=query,
                               projection=dict(content=False), limit=limit)
@@ -100,24 +182,70 @@ def text_search(coll, query, limit=50):
 
 def unpickle_json(d):
     _id = d['_id']
-    del d['_id']
-    s = json.dumps({'py/object':d['py/object'], 'py/state':d['py/state']})
-    o = jsonpickle.decode(s)
+    if 'rustTree' in d: # binary tree format, as saved by jsonize_doc()
+        o = parse.decode_trees(str(d['rustTree']), parse.PostprocDict)[0]
+    else:
+        d = {'py/object':d['py/object'], 'py/state':d['py/state']}
+        o = jsonpickle.unpickler.Unpickler().restore(d) # no JSON round trip
     o._id = _id
     return o
 
+# only the fields that unpickle_json() needs
+nodeFields = {'py/object':True, 'py/state':True, 'rustTree':True}
 
 class DocIDIndex(object):
-    'dict interface to doc collection in mongodb'
-    def __init__(self, coll=None, **kwargs):
+    '''dict interface to doc collection in mongodb, keeping the
+    maxsize most recently used nodes, and parse.resolve_select()
+    results of the maxsize most recently used select expressions'''
+    def __init__(self, coll=None, maxsize=1000, **kwargs):
         if coll is None:
             coll = get_collection(**kwargs)
         self.coll = coll
+        self.cache = parse.IndexCache(maxsize)
+        self.selectMemo = parse.IndexCache(maxsize)
     def __getitem__(self, k):
-        d = self.coll.find_one({'py/state.tokenID':k})
+        node = self.cache.get(k)
+        if node is not None:
+            return node
+        d = self.coll.find_one({'py/state.tokenID':k}, nodeFields)
         if d is None:
             raise KeyError('ID %s not found' % k)
-        return unpickle_json(d)
+        node = unpickle_json(d)
+        self.cache.set(k, node)
+        return node
+    def fetch_nodes(self, ids):
+        '''get {id:node} for the ids found, with one query for all
+        of ids not already cached'''
+        nodes = {}
+        missing = []
+        for k in set(ids):
+            node = self.cache.get(k)
+            if node is None:
+                missing.append(k)
+            else:
+                nodes[k] = node
+        if not missing:
+            return nodes
+        for d in self.coll.find({'py/state.tokenID':{'$in':missing}},
+                                nodeFields):
+            k = d['py/state']['tokenID']
+            if k not in nodes: # same doc that find_one() would give
+                nodes[k] = unpickle_json(d)
+                self.cache.set(k, nodes[k])
+        return nodes
+    def prefetch(self, ids):
+        '''fetch all of ids not already cached, in one query,
+        growing the cache to hold them all'''
+        ids = set(ids)
+        self.cache.maxsize = max(self.cache.maxsize, len(ids))
+        self.fetch_nodes(ids)
+    def get_many(self, ids):
+        'get list of nodes for list of ids, in at most one query'
+        nodes = self.fetch_nodes(ids)
+        try:
+            return [nodes[k] for k in ids]
+        except KeyError, e:
+            raise KeyError('ID %s not found' % e.args[0])
 
 class FormatIndex(object):
     'dict interface to formats stored in mongodb'
@@ -134,7 +262,7 @@ class FormatIndex(object):
         d = self.coll.find_one({'_id':k})
         if d is None:
             raise KeyError('ID %s not found' % k)
-        t = Template(d['template'])
+        t = parse.compile_template(d['template'])
         self.d[k] = t
         return t
 
@@ -143,19 +271,19 @@ def get_indexes(srcpath):
     'get doc and format index interfaces to the db'
     return DocIDIndex(), FormatIndex()
 
-def save_rust_repo(srcpath, **kwargs):
-    'save rust and formats to database'
-    import parse
+def save_rust_repo(srcpath, batchSize=1000, **kwargs):
+    'save rust and formats to database, only writing what has changed'
     path = os.path.join(srcpath, 'sourcefiles.txt')
     with open(path, 'rU') as ifile:
         srcfiles = [os.path.join(srcpath, s.strip()) for s in ifile]
     tree = parse.parse_files(srcfiles)
     docs = extract_docs(tree)
-    insert_docs(docs, **kwargs)
-    print 'inserted %d documents' % len(docs)
+    n, skipped, deleted = save_docs(docs, batchSize=batchSize, **kwargs)
+    print 'saved %d documents (%d unchanged), deleted %d' \
+          % (n, skipped, deleted)
     path = os.path.join(srcpath, 'formats.rst')
     tree = parse.parse_files([path])
     formats = extract_formats(tree)
-    insert_formats(formats, **kwargs)
-    print 'inserted %d formats' % len(formats)
+    save_formats(formats, **kwargs)
+    print 'saved %d formats' % len(formats)
 
@@ -1,11 +1,25 @@
 import os
+import re
 import shutil
-import urllib2
+import urlparse
+import httplib
+import socket
+import threading
+import json
 import subprocess
 import warnings
 import codecs
+import hashlib
+import collections
+import multiprocessing
+import multiprocessing.pool
+import tempfile
+import mmap
+import array
+import marshal
 try:
-    from jinja2 import Template
+    from jinja2 import Template, Environment, FunctionLoader, \
+         FileSystemBytecodeCache
 except ImportError:
     pass
 
@@ -34,50 +48,87 @@ docutilsMetadata = set((':width:',':alt:', ':height:', ':scale:',
                         ':Date:', ':Copyright:', ':Dedication:', ':Abstract:', 
                         ))
 
-def get_indent(i, rawtext, text):
-    if text[i]:
-        return rawtext[i].index(text[i][0])
+def is_metadata_token(token, excludeTags=docutilsMetadata):
+    'matches any :foobar: token'
+    tokens = token.split(':')
+    return len(tokens) == 3 and len(token) > 2 and \
+           tokens[0] == '' and tokens[2] == '' and token not in excludeTags
 
-def is_section_mark(i, rawtext, text):
-    rawline = rawtext[i]
-    if not rawline:
-        return False
-    line = text[i]
-    c = rawline[0]
-    if c in sectionChars and line == c * len(line) \
-           and len(line) >= minTitle:
-        return line
-
-def is_section_overline(i, rawtext, text):
-    if i + 2 < len(text) and is_section_mark(i, rawtext, text):
+# (indent, mark, tokens, isMetadata, isGlossary) entry for a blank line
+blankLine = (None, None, None, False, False)
+
+def classify_lines(rawtext, text, blockTokens=defaultBlocks):
+    '''classify each line once, as a list of
+    (indent, mark, tokens, isMetadata, isGlossary) tuples.
+    indent is None for a blank line; mark is the section-mark line
+    (or None); tokens is the block-start token list (or None).
+    Lines with neither share one tuple per distinct value, so the
+    list costs about a pointer per line'''
+    lineInfo = []
+    plainLines = {}
+    for i, line in enumerate(text):
+        if not line:
+            lineInfo.append(blankLine)
+            continue
+        rawline = rawtext[i]
+        c = rawline[0]
+        if c in sectionChars and line == c * len(line) \
+               and len(line) >= minTitle:
+            mark = line
+        else:
+            mark = None
+        if line.startswith('.. select::'):
+            tokens = ['.. select::', line[11:].lstrip()]
+            isMetadata = False
+        else:
+            tokens = line.split()
+            isMetadata = is_metadata_token(tokens[0])
+        if tokens[0] not in blockTokens:
+            tokens = None
+        t = (rawline.index(line[0]), mark, tokens, isMetadata,
+             line.startswith('.. glossary::'))
+        if mark is None and tokens is None:
+            t = plainLines.setdefault(t, t)
+        lineInfo.append(t)
+    return lineInfo
+
+def get_indent(i, lineInfo):
+    return lineInfo[i][0]
+
+def is_section_mark(i, lineInfo):
+    return lineInfo[i][1]
+
+def is_section_overline(i, rawtext, text, lineInfo):
+    if i + 2 < len(text) and is_section_mark(i, lineInfo):
         l = [rawtext[j].rstrip() for j in range(i, i + 3)]
         if len(l[0]) >= len(l[1]) and l[0] == l[2]:
             return text[i + 1], 3, l[0][1]
         
-def is_section_title(i, rawtext, text):
+def is_section_title(i, rawtext, text, lineInfo):
     if i + 2 < len(text):
-        mark = is_section_mark(i + 1, rawtext, text)
-        if mark and len(mark) >= len(text[i]) \
-           and text[i] and rawtext[i][0] == text[i][0]:
+        mark = is_section_mark(i + 1, lineInfo)
+        if mark and len(mark) >= len(text[i]) and lineInfo[i][0] == 0:
             return text[i], 2, mark[0]
 
-def is_section_start(i, rawtext, text):
-    return is_section_overline(i, rawtext, text) \
-           or is_section_title(i, rawtext, text)
+def is_section_start(i, rawtext, text, lineInfo):
+    return is_section_overline(i, rawtext, text, lineInfo) \
+           or is_section_title(i, rawtext, text, lineInfo)
 
 def not_empty(text):
     for line in text:
         if line:
             return True
 
-def generate_sections(rawtext, text, title=''):
+def generate_sections(rawtext, text, title='', lineInfo=None):
     'generate section intervals as (start, stop, title, level) tuples'
+    if lineInfo is None:
+        lineInfo = classify_lines(rawtext, text)
     lastStart = i = 0
     n = len(rawtext)
     levels = []
     level = 0
     while i < n:
-        section = is_section_start(i, rawtext, text)
+        section = is_section_start(i, rawtext, text, lineInfo)
         if section:
             if title or not_empty(text[lastStart:i]):
                 yield [lastStart, i, title, level]
@@ -92,10 +143,10 @@ def generate_sections(rawtext, text, title=''):
     if title or not_empty(text[lastStart:]):
         yield [lastStart, len(text), title, level]
 
-def get_section_forest(rawtext, text):
+def get_section_forest(rawtext, text, lineInfo=None):
     'convert generate_sections() list into trees'
     stack = [[]]
-    for t in generate_sections(rawtext, text):
+    for t in generate_sections(rawtext, text, lineInfo=lineInfo):
         level = t[3]
         if level > len(stack):
             raise ValueError('section level too big!  Debug!')
@@ -111,24 +162,66 @@ def get_section_forest(rawtext, text):
         stack[-1][-1].append(subsections)
     return stack[0] # top-level sections
 
-def is_block_start(i, rawtext, text, blockTokens):
-    tokens = text[i].split()
-    if text[i].startswith('.. select::'):
-        tokens = ['.. select::', text[i][11:].lstrip()]
-    if tokens and tokens[0] in blockTokens:
+class LineBuffer(object):
+    'rawtext lines of a file, with their stripped text and classify_lines()'
+    __slots__ = ('rawtext', 'text', 'lineInfo')
+    def __init__(self, rawtext, text=None, blockTokens=defaultBlocks,
+                 lineInfo=None):
+        if text is None:
+            if isinstance(rawtext, list):
+                text = [line.strip() for line in rawtext]
+            else: # lazy line sequence, e.g. MappedLines
+                text = StrippedLines(rawtext)
+        if lineInfo is None:
+            lineInfo = classify_lines(rawtext, text, blockTokens)
+        self.rawtext = rawtext
+        self.text = text
+        self.lineInfo = lineInfo
+
+class LineView(object):
+    '''lines [start:stop] of a LineBuffer, without copying them.
+    Line numbers passed to or returned by the functions that take
+    a LineView are always buffer (absolute) line numbers'''
+    __slots__ = ('buffer', 'start', 'stop')
+    def __init__(self, buffer, start=0, stop=None):
+        if stop is None:
+            stop = len(buffer.rawtext)
+        self.buffer = buffer
+        self.start = start
+        self.stop = stop
+    def __len__(self):
+        return self.stop - self.start
+    def view(self, start, stop):
+        'view of lines [start:stop] of the same buffer'
+        return LineView(self.buffer, start, stop)
+    def rawtext(self):
+        return self.buffer.rawtext[self.start:self.stop]
+    def text(self):
+        return self.buffer.text[self.start:self.stop]
+    def not_empty(self):
+        lineInfo = self.buffer.lineInfo
+        for i in range(self.start, self.stop):
+            if lineInfo[i][0] is not None:
+                return True
+        return False
+
+def is_block_start(i, lines, blockTokens):
+    lineInfo = lines.buffer.lineInfo
+    tokens = lineInfo[i][2]
+    if tokens:
         start = i
-        indent = get_indent(i, rawtext, text)
+        indent = get_indent(i, lineInfo)
         i += 1
         subindent = None
-        while i < len(text):
-            subindent = get_indent(i, rawtext, text)
+        while i < lines.stop:
+            subindent = get_indent(i, lineInfo)
             if subindent is not None:
                 break
             i += 1
         if subindent is not None and subindent > indent:
             i += 1
-            while i < len(text):
-                k = get_indent(i, rawtext, text)
+            while i < lines.stop:
+                k = get_indent(i, lineInfo)
                 if k is not None and k < subindent:
                     break
                 i += 1
@@ -136,12 +229,11 @@ def is_block_start(i, rawtext, text, blockTokens):
             subindent = None
         return start, i, tokens, subindent
 
-def generate_blocks(rawtext, text, blockTokens=defaultBlocks):
-    'generate top-level blocks within a text'
-    lastStart = i = 0
-    n = len(rawtext)
-    while i < n:
-        block = is_block_start(i, rawtext, text, blockTokens)
+def generate_blocks(lines, blockTokens=defaultBlocks):
+    'generate top-level blocks within a LineView'
+    i = lines.start
+    while i < lines.stop:
+        block = is_block_start(i, lines, blockTokens)
         if block:
             yield block
             i = block[1]
@@ -173,29 +265,99 @@ def split_items(rawtext, text, bullet='* '):
 def is_metadata(line, excludeTags=docutilsMetadata):
     'matches any line beginning with :foobar: pattern'
     if line and line[0] == ':':
-        token = line.split()[0]
-        tokens = token.split(':')
-        return len(tokens) == 3 and len(token) > 2 and \
-               tokens[2] == '' and token not in excludeTags
+        return is_metadata_token(line.split()[0], excludeTags)
             
 
-def extract_metadata(rawtext, text, indent):
-    'remove :foobar: metadata lines and de-indent rawtext'
-    l = []
+def extract_metadata(lines, runs):
+    '''append (start, stop) buffer offsets of the non-metadata lines
+    in LineView lines to runs, and return the :foobar: metadata lines'''
+    lineInfo = lines.buffer.lineInfo
     metadata = []
-    prefix = ' ' * indent
-    for i, line in enumerate(text):
-        if is_metadata(line):
-            metadata.append(line)
-        elif prefix and rawtext[i].startswith(prefix):
-            l.append(rawtext[i][indent:])
-        else:
-            l.append(rawtext[i])
-    return l, metadata
+    runStart = lines.start
+    for i in range(lines.start, lines.stop):
+        if lineInfo[i][3]:
+            metadata.append(lines.buffer.text[i])
+            if runStart < i:
+                runs.append((runStart, i))
+            runStart = i + 1
+    if runStart < lines.stop:
+        runs.append((runStart, lines.stop))
+    return metadata
+
+def get_metadata_dict(metadata):
+    'convert :foobar: metadata lines to dict of lists of values'
+    d = {}
+    for line in metadata:
+        attr = line.split(':')[1]
+        v = line[len(attr) + 2:].lstrip()
+        try:
+            d[attr].append(v)
+        except KeyError:
+            d[attr] = [v]
+    return d
+
+def split_block_lines(lines, blockTokens=defaultBlocks):
+    '''find the sub-blocks of LineView lines and extract its metadata,
+    as (metadata, runs, blocks), where runs are extract_metadata()
+    text runs and blocks the generate_blocks() list'''
+    blocks = list(generate_blocks(lines, blockTokens))
+    metadata = []
+    runs = []
+    stop = lines.start
+    if blocks:
+        head = lines.view(lines.start, blocks[0][0])
+        if head.not_empty():
+            metadata = extract_metadata(head, runs)
+        stop = blocks[-1][1]
+    tail = lines.view(stop, lines.stop)
+    if tail.not_empty():
+        metadata += extract_metadata(tail, runs)
+    return metadata, runs, blocks
+
+class TextLines(object):
+    '''text of a node, stored as (start, stop) runs of line offsets into
+    the file's rawtext buffer; lines() de-indents them on demand'''
+    __slots__ = ('buffer', 'runs', 'indent')
+    def __init__(self, buffer, runs, indent):
+        self.buffer = buffer
+        self.runs = tuple(runs)
+        self.indent = indent
+    def lines(self):
+        'same lines that extract_metadata() would return'
+        l = []
+        indent = self.indent
+        prefix = ' ' * indent
+        for start, stop in self.runs:
+            for line in self.buffer[start:stop]:
+                if prefix and line.startswith(prefix):
+                    l.append(line[indent:])
+                else:
+                    l.append(line)
+        return l
 
 class BlockBase(object):
+    # fixed fields are slots; any other attribute (e.g. metadata attrs,
+    # selectParams) goes in __dict__, which is only created when needed
+    __slots__ = ('tokens', 'indent', 'filepath', 'parent', 'children',
+                 'title', 'level', '_text', 'metadata', '_metadata',
+                 '__dict__')
     def __init__(self):
         pass
+    def _get_text(self):
+        text = self._text
+        if isinstance(text, TextLines):
+            return text.lines()
+        return text
+    def _set_text(self, text):
+        self._text = text
+    text = property(_get_text, _set_text)
+    def set_attrs(self, d):
+        'set attributes from dict d, without creating __dict__ if not needed'
+        for k, v in d.items():
+            if k in nodeFields:
+                setattr(self, k, v)
+            else:
+                self.__dict__[k] = v
     def copy(self):
         'deep copy of this object'
         c = BlockBase()
@@ -205,8 +367,10 @@ class BlockBase(object):
             c.title = self.title
         if hasattr(self, 'filepath'):
             c.filepath = self.filepath
-        if hasattr(self, 'text'):
-            c.text = self.text
+        try: # share text without converting it to a list
+            c._text = self._text
+        except AttributeError:
+            pass
         if hasattr(self, 'children'):
             c.children = list(self.children)
         if hasattr(self, 'metadata'):
@@ -214,6 +378,20 @@ class BlockBase(object):
         if hasattr(self, '_metadata'):
             c._metadata = self._metadata.copy()
         return c
+    def share(self):
+        '''copy of this node that shares its text, children and metadata
+        containers (copy-on-write: code must replace them, not modify
+        them in place), e.g. for the nodes inserted by apply_select()'''
+        c = BlockBase()
+        c.__class__ = self.__class__
+        c.tokens = self.tokens
+        for attr in ('title', 'filepath', '_text', 'children', 'metadata',
+                     '_metadata'):
+            try:
+                setattr(c, attr, getattr(self, attr))
+            except AttributeError:
+                pass
+        return c
     def walk(self):
         'DFS traversal of the tree'
         for c in self.children:
@@ -233,19 +411,11 @@ class BlockBase(object):
             return self._metadata
         except AttributeError:
             pass
-        d = {}
         try:
             metadata = self.metadata
         except AttributeError:
-            return d
-        for line in metadata:
-            attr = line.split(':')[1]
-            v = line[len(attr) + 2:].lstrip()
-            try:
-                d[attr].append(v)
-            except KeyError:
-                d[attr] = [v]
-        return d
+            return {}
+        return get_metadata_dict(metadata)
 
     def child_dict(self, d=None, postprocDict={}):
         if d is None:
@@ -268,8 +438,8 @@ class BlockBase(object):
 
     def add_metadata_attrs(self, postprocDict={}):
         'add metadata as attributes on this obj'
-        self.__dict__.update(self.metadata_dict())
-        self.__dict__.update(self.child_dict(None, postprocDict))
+        self.set_attrs(self.metadata_dict())
+        self.set_attrs(self.child_dict(None, postprocDict))
 
     def __getstate__(self):
         d = dict(tokens=getattr(self, 'tokens', ()), 
@@ -281,26 +451,53 @@ class BlockBase(object):
             d['tokenID'] = self.tokens[1]
         except (AttributeError, IndexError):
             pass
+        for attr in stateAttrs:
+            try:
+                d[attr] = getattr(self, attr)
+            except AttributeError:
+                pass
         return d
-    def __setstate__(self, d):
+    def restore_state(self, d):
+        'restore attributes saved by __getstate__(), without metadata attrs'
         self.tokens = d['tokens']
         self._metadata = d['metadata']
         self.text = d['text']
-        self.title = d['title']
+        if d['title']:
+            self.title = d['title']
         self.children = d['children']
+        for attr in stateAttrs:
+            if attr in d:
+                setattr(self, attr, d[attr])
+        for c in self.children: # parser only links blocks to their parent
+            if not isinstance(c, Section):
+                c.parent = self
+    def __setstate__(self, d):
+        self.restore_state(d)
         self.add_metadata_attrs(PostprocDict)
 
+# optional attributes saved by __getstate__() if present
+stateAttrs = ('indent', 'filepath', 'level', 'conceptID', 'glossary')
+
+# attributes that set_attrs() must not put in __dict__
+nodeFields = frozenset(BlockBase.__slots__ + ('text',))
 
 class Block(BlockBase):
     'a RUsT block, containing text and / or subblocks'
+    __slots__ = ()
     def __init__(self, tokens, rawtext, text, indent=0,
                  blockTokens=defaultBlocks, filepath=None, mongoIndex=None,
-                 mongoFormats=None, **kwargs):
+                 mongoFormats=None, lines=None, **kwargs):
+        '''block contents are either rawtext and text lists, or
+        a LineView lines (in which case rawtext and text are ignored)'''
         self.tokens = tokens
         self.indent = indent
         self.filepath = filepath
-        self.__dict__.update(kwargs)
+        self.set_attrs(kwargs)
+        if lines is None and rawtext is not None:
+            lines = LineView(LineBuffer(rawtext, text, blockTokens))
         if tokens[0] == '.. select::':
+            if lines is not None:
+                rawtext, text = lines.rawtext(), lines.text()
             result = parse_select(rawtext, text, tokens[1], filepath, 
                                   mongoIndex=mongoIndex,
                                   mongoFormats=mongoFormats)
@@ -309,32 +506,25 @@ class Block(BlockBase):
                 self.children = []
             else:
                 self.children = result
-        elif rawtext: # parse sub-blocks, metadata
-            self.parse(rawtext, text, blockTokens, mongoIndex=mongoIndex,
-                       mongoFormats=mongoFormats)
+        elif lines: # parse sub-blocks, metadata
+            self.parse(lines, blockTokens,
+                       mongoIndex=mongoIndex, mongoFormats=mongoFormats)
         else: # empty
-            self.text = text
+            self.text = text if lines is None else []
             self.children = []
-    def parse(self, rawtext, text, blockTokens, **kwargs):
-        'parse into sub-blocks, if any, and extract metadata'
+    def parse(self, lines, blockTokens, **kwargs):
+        'parse LineView lines into sub-blocks, if any, and extract metadata'
+        self.metadata, runs, blocks = split_block_lines(lines, blockTokens)
         children = []
-        stop = 0
-        self.text = []
-        self.metadata = []
-        for start, stop, tokens, indent in generate_blocks(rawtext, text,
-                                                           blockTokens):
-            if not children and not_empty(text[:start]):
-                self.text, self.metadata = \
-                           extract_metadata(rawtext[:start], text[:start],
-                                            self.indent)
-            children.append(Block(tokens, rawtext[start + 1:stop],
-                                  text[start + 1:stop], indent, blockTokens,
-                                  self.filepath, parent=self, **kwargs))
-        if not_empty(text[stop:]):
-            addtext, metadata = \
-                     extract_metadata(rawtext[stop:], text[stop:], self.indent)
-            self.text += addtext
-            self.metadata += metadata
+        for start, stop, tokens, indent in blocks:
+            children.append(Block(tokens, None, None, indent, blockTokens,
+                                  self.filepath, parent=self,
+                                  lines=lines.view(start + 1, stop),
+                                  **kwargs))
+        if runs:
+            self.text = TextLines(lines.buffer.rawtext, runs, self.indent)
+        else:
+            self.text = []
         self.children = children
 
     def get_children(self, token):
@@ -373,26 +563,30 @@ class Block(BlockBase):
 
 class Section(Block):
     'a ReST section, containing text, subblocks and / or subsections'
+    __slots__ = ()
     def __init__(self, t, rawtext, text, blockTokens=defaultBlocks,
-                 filepath=None, **kwargs):
+                 filepath=None, buffer=None, **kwargs):
         start, stop, title, level = t[:4]
-        Block.__init__(self, ('section',), rawtext[start:stop],
-                       text[start:stop], blockTokens=blockTokens,
-                       filepath=filepath,
-                       title=(title,), level=level, **kwargs)
+        if buffer is None:
+            buffer = LineBuffer(rawtext, text, blockTokens)
+        lines = LineView(buffer, start, stop)
+        Block.__init__(self, ('section',), None, None,
+                       blockTokens=blockTokens, filepath=filepath,
+                       lines=lines, title=(title,), level=level, **kwargs)
         if len(t) > 4: # append subsections after subblocks
             for subsection in t[4]:
                 self.children.append(Section(subsection, rawtext, text,
                                              blockTokens=blockTokens,
-                                             filepath=filepath))
+                                             filepath=filepath,
+                                             buffer=buffer))
         for line in getattr(self, 'metadata', ()):
             if line.startswith(':ID:'): # extract section ID
                 self.tokens = ('section', line.split()[1])
             if line.startswith(':defines:'): # extract concept ID
                 self.conceptID = line.split()[1]
-        for i,line in enumerate(text[start:stop]):
-            if line.startswith('.. glossary::'):
-                save_glossary(self, i, rawtext[start:stop], text[start:stop])
+        for i in range(start, stop):
+            if buffer.lineInfo[i][4]: # glossary directive
+                save_glossary(self, i, lines)
     def list_repr(self, textFunc, postprocDict):
         'get list of dicts repr of this subtree'
         l = []
@@ -414,13 +608,17 @@ class Section(Block):
             l = [d] + l
         return l
 
-def save_glossary(node, start, rawtext, text):
-    'save glossary as node list on node.glossary'
+def get_glossary(start, lines):
+    '''get [(term, definition lines),...] for the glossary starting
+    at line start of LineView lines'''
+    rawtext = lines.buffer.rawtext
+    text = lines.buffer.text
+    lineInfo = lines.buffer.lineInfo
     subindent = subindent2 = None
-    indent = get_indent(start, rawtext, text)
+    indent = get_indent(start, lineInfo)
     i = start + 1
-    while i < len(text): # find 1st indented glossary term
-        subindent = get_indent(i, rawtext, text)
+    while i < lines.stop: # find 1st indented glossary term
+        subindent = get_indent(i, lineInfo)
         if subindent is not None:
             break
         i += 1
@@ -430,8 +628,8 @@ def save_glossary(node, start, rawtext, text):
     l = []
     v = []
     subindent3 = 0
-    while i < len(text): # read glossary definitions
-        subindent2 = get_indent(i, rawtext, text)
+    while i < lines.stop: # read glossary definitions
+        subindent2 = get_indent(i, lineInfo)
         if subindent2 is not None:
             if subindent2 < subindent:
                 break
@@ -449,6 +647,11 @@ def save_glossary(node, start, rawtext, text):
         i += 1
     if k: # save the last glossary definition
         l.append((k, v))
+    return l
+
+def save_glossary(node, start, lines):
+    'save glossary starting at line start of LineView lines as node.glossary'
+    l = get_glossary(start, lines)
     if l: # save glossary as node list
         nodes = []
         for k,v in l:
@@ -457,8 +660,9 @@ def save_glossary(node, start, rawtext, text):
 
                 
 class Document(BlockBase):
+    __slots__ = ()
     def __init__(self, **kwargs):
-        self.__dict__.update(kwargs)
+        self.set_attrs(kwargs)
         self.children = []
     def append(self, v):
         self.children.append(v)
@@ -469,13 +673,18 @@ class Document(BlockBase):
             l += c.list_repr(textFunc, postprocDict)
         return l
 
+# node classes that decode_node() can rebuild
+nodeClasses = dict(Block=Block, Section=Section)
+
 def parse_rust(rawtext, filepath=None, doc=None, **kwargs):
     'top level block parser, returns list of sections'
     if doc is None:
         doc = Document()
-    text = [line.strip() for line in rawtext]
-    for t in get_section_forest(rawtext, text):
-        doc.append(Section(t, rawtext, text, filepath=filepath, **kwargs))
+    buffer = LineBuffer(rawtext,
+                        blockTokens=kwargs.get('blockTokens', defaultBlocks))
+    for t in get_section_forest(rawtext, buffer.text, buffer.lineInfo):
+        doc.append(Section(t, rawtext, buffer.text, filepath=filepath,
+                           buffer=buffer, **kwargs))
     return doc
 
 def parse_rust_docinfo(rawtext, filepath=None, doc=None, **kwargs):
@@ -489,31 +698,350 @@ def parse_rust_docinfo(rawtext, filepath=None, doc=None, **kwargs):
                 author = s[8:].strip()
     return doc, title, author
 
-def parse_file(filename, **kwargs):
-    'read RUsT from specified file'
+# compact binary tree format: treeFormatMagic, version byte, then
+# marshal of (string table, node tuples), where each node tuple is
+# (class, tokens, metadata, text, title, children, extra stateAttrs)
+# with class names, tokens, metadata and file paths as string indices
+treeFormatMagic = 'RUsT'
+treeFormatVersion = 1
+
+class TreeEncoder(object):
+    'converts nodes to tuples of builtin types, interning their strings'
+    def __init__(self):
+        self.strings = []
+        self.index = {}
+    def intern(self, s):
+        'get string table index of s'
+        k = (s.__class__, s) # keep str and unicode distinct
+        try:
+            return self.index[k]
+        except KeyError:
+            i = self.index[k] = len(self.strings)
+            self.strings.append(s)
+            return i
+    def encode(self, node):
+        'convert node subtree to nested tuples, via __getstate__()'
+        intern = self.intern
+        d = node.__getstate__()
+        tokens = d['tokens']
+        extras = []
+        for attr in stateAttrs:
+            try:
+                v = d[attr]
+            except KeyError:
+                continue
+            if attr == 'filepath':
+                v = intern(v)
+            elif attr == 'glossary':
+                v = tuple([self.encode(c) for c in v])
+            extras.append((intern(attr), v))
+        return (intern(node.__class__.__name__),
+                tokens.__class__([intern(t) for t in tokens]),
+                tuple([(intern(k), [intern(v) for v in l])
+                       for k, l in d['metadata'].items()]),
+                d['text'], d['title'],
+                tuple([self.encode(c) for c in d['children']]),
+                tuple(extras))
+
+def encode_trees(nodes):
+    'encode list of subtrees in the compact binary tree format'
+    encoder = TreeEncoder()
+    l = [encoder.encode(node) for node in nodes]
+    return treeFormatMagic + chr(treeFormatVersion) \
+           + marshal.dumps((encoder.strings, l), 2)
+
+def decode_node(t, strings, postprocDict=None):
+    'rebuild subtree from TreeEncoder.encode() tuples'
+    cls, tokens, metadata, text, title, children, extras = t
+    d = dict(tokens=tokens.__class__([strings[i] for i in tokens]),
+             metadata=dict([(strings[k], [strings[i] for i in l])
+                            for k, l in metadata]),
+             text=text, title=title,
+             children=[decode_node(c, strings, postprocDict)
+                       for c in children])
+    for i, v in extras:
+        attr = strings[i]
+        if attr == 'filepath':
+            v = strings[v]
+        elif attr == 'glossary':
+            v = [decode_node(c, strings, postprocDict) for c in v]
+        d[attr] = v
+    node = BlockBase()
+    node.__class__ = nodeClasses[strings[cls]]
+    node.restore_state(d)
+    if postprocDict is not None: # same as __setstate__()
+        node.add_metadata_attrs(postprocDict)
+    return node
+
+def decode_trees(data, postprocDict=None):
+    '''decode encode_trees() data to list of subtrees.  If postprocDict
+    is given, add metadata attrs to each node, as __setstate__() does'''
+    if data[:len(treeFormatMagic)] != treeFormatMagic:
+        raise ValueError('not RUsT binary tree data')
+    version = ord(data[len(treeFormatMagic)])
+    if version != treeFormatVersion:
+        raise ValueError('unsupported tree format version %d' % version)
+    strings, l = marshal.loads(data[len(treeFormatMagic) + 1:])
+    return [decode_node(t, strings, postprocDict) for t in l]
+
+parseCacheDir = '_rust_cache'
+parseCacheVersion = 2
+
+def get_cache_path(filename, cacheDir):
+    'path of the parse cache file for the specified source file'
+    h = hashlib.sha1(os.path.abspath(filename)).hexdigest()
+    return os.path.join(cacheDir, h + '.rust')
+
+def get_content_hash(s, blockTokens=defaultBlocks):
+    'hash of file contents plus the parser settings that affect the tree'
+    if isinstance(s, MappedLines): # same hash as the decoded text
+        h = hashlib.sha1(repr((parseCacheVersion, 'unicode',
+                               tuple(blockTokens))))
+        h.update(s.data)
+        return h.hexdigest()
+    h = hashlib.sha1(repr((parseCacheVersion, type(s).__name__,
+                           tuple(blockTokens))))
+    if isinstance(s, unicode):
+        s = s.encode('utf-8')
+    h.update(s)
+    return h.hexdigest()
+
+def load_parse_cache(filename, contentHash, cacheDir=parseCacheDir):
+    'get cached list of top-level sections, or None if missing or stale'
+    try:
+        with open(get_cache_path(filename, cacheDir), 'rb') as ifile:
+            savedHash = ifile.readline().rstrip('\n')
+            if savedHash != contentHash: # file has changed
+                return None
+            sections = decode_trees(ifile.read())
+    except (IOError, EOFError, ValueError, TypeError):
+        return None
+    for section in sections: # same file may be named by a different path
+        for node in section.walk():
+            node.filepath = filename
+            for term in getattr(node, 'glossary', ()):
+                term.filepath = filename
+    return sections
+
+def has_select(sections):
+    'True if any node in these sections is a .. select:: directive'
+    for section in sections:
+        for node in section.walk():
+            if node.tokens[0] == '.. select::':
+                return True
+    return False
+
+unwritableCacheDirs = set() # parse cache dirs we already warned about
+
+def save_parse_cache(filename, contentHash, sections, cacheDir=parseCacheDir):
+    '''save list of top-level sections, unless they depend on other files.
+    Failing to write the cache only prints a warning (once per cacheDir)'''
+    if has_select(sections):
+        return # result depends on other sources, so cannot cache
+    path = get_cache_path(filename, cacheDir)
+    data = encode_trees(sections)
+    tmppath = '%s.%d' % (path, os.getpid())
+    try:
+        mkdir_if_needed(cacheDir)
+        with open(tmppath, 'wb') as ofile:
+            ofile.write(contentHash + '\n')
+            ofile.write(data)
+        os.rename(tmppath, path) # never leave a partly written cache file
+    except (IOError, OSError), e:
+        if cacheDir not in unwritableCacheDirs:
+            unwritableCacheDirs.add(cacheDir)
+            print 'WARNING: cannot write parse cache %s: %s' % (cacheDir, e)
+        try:
+            os.remove(tmppath)
+        except OSError:
+            pass
+
+# files of at least this many bytes are read via MappedLines
+mmapMinSize = 1 << 24
+
+class MappedLines(object):
+    '''lines of a UTF-8 file, decoded on demand from a read-only mmap,
+    so only the line offset index is kept in memory'''
+    def __init__(self, filename, encoding='utf-8'):
+        with open(filename, 'rb') as ifile:
+            self.data = mmap.mmap(ifile.fileno(), 0, access=mmap.ACCESS_READ)
+        self.encoding = encoding
+        offsets = array.array('l', [0]) # start of each line
+        find = self.data.find
+        i = find('\n')
+        while i >= 0:
+            offsets.append(i + 1)
+            i = find('\n', i + 1)
+        self.offsets = offsets
+    def __len__(self):
+        return len(self.offsets)
+    def line(self, i):
+        start = self.offsets[i]
+        if i + 1 < len(self.offsets):
+            stop = self.offsets[i + 1] - 1
+        else: # last line
+            stop = len(self.data)
+        return self.data[start:stop].decode(self.encoding)
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.line(j) for j in xrange(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError('line index out of range')
+        return self.line(i)
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self.line(i)
+
+class StrippedLines(object):
+    'stripped lines of a line sequence, computed on demand'
+    def __init__(self, rawtext):
+        self.rawtext = rawtext
+    def __len__(self):
+        return len(self.rawtext)
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [line.strip() for line in self.rawtext[i]]
+        return self.rawtext[i].strip()
+    def __iter__(self):
+        for line in self.rawtext:
+            yield line.strip()
+
+def read_source(filename):
+    '''read file as unicode: a string, or MappedLines if it is
+    at least mmapMinSize bytes'''
+    if os.path.getsize(filename) >= mmapMinSize:
+        return MappedLines(filename)
     with codecs.open(filename, 'rU', encoding='utf-8') as ifile:
-        rawtext = ifile.read().split('\n')
-    return parse_rust(rawtext, filename, **kwargs)
+        return ifile.read()
+
+def split_lines(s):
+    'rawtext line sequence for read_source() result s'
+    if isinstance(s, MappedLines):
+        return s
+    return s.split('\n')
+
+def parse_text(s, filename, doc, cacheDir=parseCacheDir, **kwargs):
+    '''parse file contents s (a read_source() result), using cached
+    parse of unchanged files.  MappedLines sources are never cached,
+    since that would hold their whole text in memory'''
+    if not cacheDir or isinstance(s, MappedLines):
+        return parse_rust(split_lines(s), filename, doc, **kwargs)
+    contentHash = get_content_hash(s, kwargs.get('blockTokens',
+                                                 defaultBlocks))
+    if doc is None:
+        doc = Document()
+    sections = load_parse_cache(filename, contentHash, cacheDir)
+    if sections is None: # have to parse it
+        n = len(doc.children)
+        parse_rust(split_lines(s), filename, doc, **kwargs)
+        save_parse_cache(filename, contentHash, doc.children[n:], cacheDir)
+    else:
+        for section in sections:
+            doc.append(section)
+    return doc
+
+def parse_file(filename, doc=None, **kwargs):
+    'read RUsT from specified file'
+    return parse_text(read_source(filename), filename, doc, **kwargs)
     
-def parse_files(filenames, **kwargs):
-    'read RUsT from specified files'
-    doc = Document()
+def file_has_select(filename):
+    'quick pre-scan: True if any line of filename is a .. select::'
+    with open(filename, 'rb') as ifile:
+        for line in ifile:
+            if line.lstrip().startswith('.. select::'):
+                return True
+    return False
+
+def init_parse_worker():
+    'process pool initializer: never start a pool inside a worker'
+    global parseWorkers
+    parseWorkers = None
+
+def parse_file_state(args):
+    '''process pool worker: parse one file, return its encode_trees()
+    data, or None if it must be parsed in the calling process'''
+    filename, kwargs = args
+    sections = parse_file(filename, **kwargs).children
+    if has_select(sections): # select results cannot be shipped back
+        return None
+    return encode_trees(sections)
+
+def parse_file_trees(filenames, workers=None, **kwargs):
+    '''parse each file as a separate Document, using a pool of worker
+    processes if requested; returns Documents in filenames order.
+    Files containing a .. select:: are always parsed in this process,
+    since their results depend on other sources'''
+    if workers:
+        poolFiles = [filename for filename in filenames
+                     if not file_has_select(filename)]
+    if not workers or len(poolFiles) < 2:
+        return [parse_file(filename, **kwargs)
+                for filename in filenames]
+    pool = multiprocessing.Pool(workers, init_parse_worker)
+    try:
+        results = pool.map(parse_file_state,
+                           [(filename, kwargs) for filename in poolFiles])
+    finally:
+        pool.close()
+        pool.join()
+    results = dict(zip(poolFiles, results))
+    docs = []
     for filename in filenames:
-        with open(filename, 'rU') as ifile:
-            rawtext = ifile.read().split('\n')
-        parse_rust(rawtext, filename, doc, **kwargs)
+        data = results.get(filename)
+        if data is None: # parse it here instead
+            docs.append(parse_file(filename, **kwargs))
+            continue
+        doc = Document()
+        for section in decode_trees(data):
+            doc.append(section)
+        docs.append(doc)
+    return docs
+
+# default number of worker processes for parsing select sources
+parseWorkers = None
+
+# if True, select sources are pre-scanned and parsed lazily (see RustIndex)
+lazyParse = False
+
+def parse_files(filenames, workers=None, **kwargs):
+    '''read RUsT from specified files, optionally parsing them in
+    a pool of worker processes'''
+    doc = Document()
+    for fileDoc in parse_file_trees(filenames, workers, **kwargs):
+        for section in fileDoc.children:
+            doc.append(section)
     return doc
 
 
 class MultiDict(dict):
     'instead of over-writing existing key, add numbered variant k.2, k.3 etc.'
     def __setitem__(self, k, v):
+        self.add(k, v)
+    def add(self, k, v):
+        'save v under k or its first free numbered variant, return that key'
         i = 2
         k0 = k
         while self.get(k, v) != v:
             k = '%s.%d' % (k0, i)
             i += 1
         dict.__setitem__(self, k, v)
+        return k
+
+class LazyMultiDict(MultiDict):
+    'MultiDict that parses LazyNode values when they are looked up'
+    def __getitem__(self, k):
+        v = dict.__getitem__(self, k)
+        if isinstance(v, LazyNode):
+            return v.resolve()
+        return v
+
+def split_numbered_key(k):
+    'get k0 if k looks like a MultiDict numbered variant k0.N, else None'
+    t = k.rsplit('.', 1)
+    if len(t) == 2 and t[1].isdigit():
+        return t[0]
 
 def standardize_identifier(s, replacements={',':';', '(':'', ')':''}):
     'remove / replace characters not allowed in identifiers'
@@ -523,20 +1051,15 @@ def standardize_identifier(s, replacements={',':';', '(':'', ')':''}):
     return s
     
 
-def index_rust(tree, d=None, formatDict=None):
-    'build flat index of block IDs'
-    if d is None:
-        d = MultiDict()
-    if formatDict is None:
-        formatDict = {}
+def generate_index_entries(tree, formatDict):
+    'generate (key, node) index entries, saving templates in formatDict'
     for node in tree.walk():
-        for line in getattr(node, 'metadata', ()):
-            if line.startswith(':proves:'): # extract concept.proof
-                k = standardize_identifier(line.split()[1]) + '.proof'
-                d[k] = node
+        for v in node.metadata_dict().get('proves', ()):
+            k = standardize_identifier(v.split()[0]) + '.proof' # concept.proof
+            yield k, node
         try:
             k = standardize_identifier(node.conceptID) + '.definition'
-            d[k] = node
+            yield k, node
         except AttributeError:
             pass
         try:
@@ -547,19 +1070,314 @@ def index_rust(tree, d=None, formatDict=None):
             for gnode in node.glossary:
                 term = standardize_identifier(gnode.tokens[1])
                 k = 'glossary.' + term
-                d[k] = gnode
+                yield k, gnode
         if hasattr(node, 'tokens'):
             if len(node.tokens) > 1:
                 if node.tokens[0] == ':format:':
                     s = '\n'.join(node.text)
-                    formatDict[node.tokens[1]] = Template(s)
+                    formatDict[node.tokens[1]] = compile_template(s)
                 else:
-                    d[standardize_identifier(node.tokens[1])] = node
+                    yield standardize_identifier(node.tokens[1]), node
             elif conceptID: # save in conceptID.token format
                 k = conceptID + '.' + node.tokens[0].split(':')[1]
-                d[k] = node
+                yield k, node
+
+def index_rust(tree, d=None, formatDict=None):
+    'build flat index of block IDs'
+    if d is None:
+        d = MultiDict()
+    if formatDict is None:
+        formatDict = {}
+    for k, node in generate_index_entries(tree, formatDict):
+        d[k] = node
     return d, formatDict
 
+class LazyFile(object):
+    '''a source file whose top-level sections are only parsed when
+    a node in them is first needed.  Note that a .. select:: directive
+    within such a section is processed when the section is parsed.'''
+    def __init__(self, rawtext, filepath=None, **kwargs):
+        self.rawtext = rawtext
+        self.filepath = filepath
+        self.kwargs = kwargs
+        self.buffer = None
+        self.forest = None # get_section_forest() list
+        self.sections = {}
+    def get_buffer(self):
+        if self.buffer is None:
+            self.buffer = LineBuffer(self.rawtext, blockTokens=
+                                     self.kwargs.get('blockTokens',
+                                                     defaultBlocks))
+        return self.buffer
+    def get_section(self, i):
+        'parse top-level section i, if not already done'
+        try:
+            return self.sections[i]
+        except KeyError:
+            pass
+        buffer = self.get_buffer()
+        section = Section(self.forest[i], self.rawtext, buffer.text,
+                          filepath=self.filepath, buffer=buffer,
+                          **self.kwargs)
+        self.sections[i] = section
+        return section
+
+class LazyNode(object):
+    '''node of a LazyFile, located by its path of child indices from
+    a top-level section (and glossary index, for a glossary term)'''
+    __slots__ = ('lazyFile', 'path', 'glossaryIndex')
+    def __init__(self, lazyFile, path, glossaryIndex=None):
+        self.lazyFile = lazyFile
+        self.path = path
+        self.glossaryIndex = glossaryIndex
+    def resolve(self):
+        'parse the section containing this node, and return the node'
+        node = self.lazyFile.get_section(self.path[0])
+        for i in self.path[1:]:
+            node = node.children[i]
+        if self.glossaryIndex is not None:
+            node = node.glossary[self.glossaryIndex]
+        return node
+
+def scan_rust(rawtext, filepath=None, **kwargs):
+    '''fast pre-scan of RUsT for its index entries, without building
+    its tree.  Returns the (key, LazyNode) list that
+    generate_index_entries() would give for parse_rust(), and the
+    format dict; only sections containing a :format: get parsed'''
+    blockTokens = kwargs.get('blockTokens', defaultBlocks)
+    lazyFile = LazyFile(rawtext, filepath, **kwargs)
+    buffer = lazyFile.get_buffer()
+    lazyFile.forest = get_section_forest(rawtext, buffer.text,
+                                         buffer.lineInfo)
+    entries = []
+    formatDict = {}
+    for i, t in enumerate(lazyFile.forest):
+        scan_section(t, (i,), lazyFile, blockTokens, entries, formatDict)
+    lazyFile.buffer = None # only rebuild it if a section gets parsed
+    return entries, formatDict
+
+def scan_file(filename, **kwargs):
+    'scan_rust() the specified file'
+    return scan_rust(split_lines(read_source(filename)), filename, **kwargs)
+
+def get_proof_entries(metadata, node):
+    for v in get_metadata_dict(metadata).get('proves', ()):
+        yield standardize_identifier(v.split()[0]) + '.proof', node
+
+def scan_section(t, path, lazyFile, blockTokens, entries, formatDict):
+    'append index entries for section t and its subtree to entries'
+    start, stop = t[:2]
+    lines = LineView(lazyFile.buffer, start, stop)
+    metadata = ()
+    blocks = ()
+    if lines:
+        metadata, runs, blocks = split_block_lines(lines, blockTokens)
+    sectionID = conceptID = None
+    for line in metadata:
+        if line.startswith(':ID:'):
+            sectionID = line.split()[1]
+        if line.startswith(':defines:'):
+            conceptID = line.split()[1]
+    for i, block in enumerate(blocks):
+        scan_block(block, path + (i,), conceptID, lazyFile, blockTokens,
+                   entries, formatDict)
+    if len(t) > 4: # subsections come after subblocks
+        for i, subsection in enumerate(t[4], len(blocks)):
+            scan_section(subsection, path + (i,), lazyFile, blockTokens,
+                         entries, formatDict)
+    node = LazyNode(lazyFile, path)
+    entries += get_proof_entries(metadata, node)
+    if conceptID:
+        entries.append((standardize_identifier(conceptID) + '.definition',
+                        node))
+    glossary = ()
+    for i in range(start, stop):
+        if lazyFile.buffer.lineInfo[i][4]: # glossary directive
+            glossary = get_glossary(i, lines)
+    for i, (k, v) in enumerate(glossary):
+        entries.append(('glossary.' + standardize_identifier(k),
+                        LazyNode(lazyFile, path, i)))
+    if sectionID:
+        entries.append((standardize_identifier(sectionID), node))
+
+def scan_block(block, path, conceptID, lazyFile, blockTokens, entries,
+               formatDict):
+    '''append index entries for generate_blocks() block and its
+    subtree to entries; conceptID is that of its parent'''
+    start, stop, tokens = block[:3]
+    lines = LineView(lazyFile.buffer, start + 1, stop)
+    metadata = ()
+    blocks = ()
+    if tokens[0] != '.. select::' and lines:
+        metadata, runs, blocks = split_block_lines(lines, blockTokens)
+    for i, subblock in enumerate(blocks):
+        scan_block(subblock, path + (i,), None, lazyFile, blockTokens,
+                   entries, formatDict)
+    node = LazyNode(lazyFile, path)
+    entries += get_proof_entries(metadata, node)
+    if len(tokens) > 1:
+        if tokens[0] == ':format:': # need its text, so parse it now
+            s = '\n'.join(node.resolve().text)
+            formatDict[tokens[1]] = compile_template(s)
+        else:
+            entries.append((standardize_identifier(tokens[1]), node))
+    elif conceptID: # save in conceptID.token format
+        k = standardize_identifier(conceptID) + '.' + tokens[0].split(':')[1]
+        entries.append((k, node))
+
+def get_file_entries(tree):
+    'get (entries, formats) for RustIndex.add_entries()'
+    formats = {}
+    entries = list(generate_index_entries(tree, formats))
+    return entries, formats
+
+class RustIndex(object):
+    '''index_rust() results for a list of source files, updated
+    incrementally by re-parsing and re-indexing only changed files.
+    Numbered duplicate keys (k.2, k.3 etc.) are always assigned in
+    source file order, exactly as a full index_rust() would.
+    If lazy, files are only pre-scanned with scan_file(), and a section
+    is parsed when one of its nodes is first looked up in self.d.'''
+    def __init__(self, lazy=False):
+        self.lazy = lazy
+        if lazy:
+            self.d = LazyMultiDict()
+        else:
+            self.d = MultiDict()
+        self.formatDict = {}
+        self.srcfiles = []
+        self.fileIndex = {}
+        self.stamps = {}
+        self.fileEntries = {} # {path:[(k, node),...]} in index_rust() order
+        self.fileKeys = {} # {path:{k:[node,...]}}
+        self.fileFormats = {} # {path:{formatID:template}}
+        self.keyFiles = {} # {k:set(paths)}
+        self.formatFiles = {} # {formatID:set(paths)}
+        self.assigned = {} # {k:[keys used for k in self.d]}
+        self.numberedKeys = {} # {k0:count of source keys like k0.N}
+    def update(self, srcfiles, stamps=None, workers=None):
+        '''re-index files that were added, removed or changed
+        since the last update; return list of re-parsed files.
+        workers is passed to parse_file_trees() (unless lazy)'''
+        if stamps is None:
+            stamps = get_file_stamps(srcfiles)
+        stamps = dict((t[0], t[1:]) for t in stamps)
+        removed = [path for path in self.srcfiles if path not in stamps]
+        changed = [path for path in srcfiles
+                   if self.stamps.get(path) != stamps[path]]
+        if not removed and not changed and srcfiles == self.srcfiles:
+            return changed # nothing to do
+        # parse everything before changing the index, so that a parse
+        # error (e.g. in a file being edited) leaves it as it was
+        if self.lazy:
+            parsed = [(path,) + tuple(scan_file(path)) for path in changed]
+        else:
+            parsed = [(path,) + get_file_entries(tree) for path, tree
+                      in zip(changed, parse_file_trees(changed, workers))]
+        self.d.selectMemo = {} # resolve_select() results may be stale
+        keys = set()
+        formatIDs = set()
+        for path in removed + changed:
+            self.remove_file(path, keys, formatIDs)
+        for path, entries, formats in parsed:
+            self.add_entries(path, entries, formats, keys, formatIDs)
+        oldFiles = set(self.srcfiles)
+        oldOrder = [path for path in self.srcfiles if path in stamps]
+        self.srcfiles = list(srcfiles)
+        self.fileIndex = dict((path, i) for i, path in enumerate(srcfiles))
+        self.stamps = stamps
+        if oldOrder != [path for path in srcfiles if path in oldFiles] \
+           or self.numbering_depends_on_order(keys):
+            self.rebuild()
+        else: # only need to renumber the affected keys
+            for k in keys:
+                self.reindex_key(k)
+            for formatID in formatIDs:
+                self.reindex_format(formatID)
+        return changed
+    def add_entries(self, path, entries, formats, keys, formatIDs):
+        'save (k, node) entries and formats dict for path'
+        fileKeys = {}
+        for k, node in entries:
+            try:
+                fileKeys[k].append(node)
+            except KeyError:
+                fileKeys[k] = [node]
+                keys.add(k)
+                self.add_key_file(k, path)
+        self.fileEntries[path] = entries
+        self.fileKeys[path] = fileKeys
+        self.fileFormats[path] = formats
+        for formatID in formats:
+            self.formatFiles.setdefault(formatID, set()).add(path)
+            formatIDs.add(formatID)
+    def remove_file(self, path, keys, formatIDs):
+        'drop index entries for path, adding their keys to keys'
+        self.fileEntries.pop(path, None)
+        for k in self.fileKeys.pop(path, ()):
+            keys.add(k)
+            self.remove_key_file(k, path)
+        for formatID in self.fileFormats.pop(path, ()):
+            formatIDs.add(formatID)
+            paths = self.formatFiles[formatID]
+            paths.discard(path)
+            if not paths:
+                del self.formatFiles[formatID]
+    def add_key_file(self, k, path):
+        try:
+            self.keyFiles[k].add(path)
+        except KeyError:
+            self.keyFiles[k] = set((path,))
+            k0 = split_numbered_key(k)
+            if k0 is not None:
+                self.numberedKeys[k0] = self.numberedKeys.get(k0, 0) + 1
+    def remove_key_file(self, k, path):
+        paths = self.keyFiles[k]
+        paths.discard(path)
+        if not paths:
+            del self.keyFiles[k]
+            k0 = split_numbered_key(k)
+            if k0 is not None:
+                self.numberedKeys[k0] -= 1
+                if not self.numberedKeys[k0]:
+                    del self.numberedKeys[k0]
+    def numbering_depends_on_order(self, keys):
+        '''True if any of keys could collide with another key's
+        numbered variant, so only a full rebuild numbers them correctly'''
+        for k in keys:
+            if k in self.numberedKeys or split_numbered_key(k) is not None:
+                return True
+        return False
+    def rebuild(self):
+        're-number all keys in source file order, without re-parsing'
+        self.d.clear()
+        self.assigned = {}
+        self.formatDict.clear()
+        for path in self.srcfiles:
+            for k, node in self.fileEntries[path]:
+                self.assigned.setdefault(k, []).append(self.d.add(k, node))
+            self.formatDict.update(self.fileFormats[path])
+    def reindex_key(self, k):
+        're-number all entries for k in source file order'
+        for key in self.assigned.pop(k, ()):
+            self.d.pop(key, None)
+        l = []
+        for path in sorted(self.keyFiles.get(k, ()),
+                           key=self.fileIndex.__getitem__):
+            for node in self.fileKeys[path][k]:
+                l.append(self.d.add(k, node))
+        if l:
+            self.assigned[k] = l
+    def reindex_format(self, formatID):
+        'use the last definition of formatID in source file order'
+        try:
+            paths = self.formatFiles[formatID]
+        except KeyError:
+            self.formatDict.pop(formatID, None)
+            return
+        path = max(paths, key=self.fileIndex.__getitem__)
+        self.formatDict[formatID] = self.fileFormats[path][formatID]
+
 def find_source_files(srcpath, filterFunc=lambda s:s.endswith('.rst')):
     srcfiles = []
     for dirpath, dirnames, filenames in os.walk(srcpath):
@@ -570,25 +1388,64 @@ def find_source_files(srcpath, filterFunc=lambda s:s.endswith('.rst')):
                 srcfiles.append(os.path.join(dirpath, filename))
     return srcfiles
 
-def load_source_path(srcpath, ongoing=[], **kwargs):
+def get_file_stamps(srcfiles):
+    'list of (path, mtime, size) for detecting changed source files'
+    l = []
+    for path in srcfiles:
+        st = os.stat(path)
+        l.append((path, st.st_mtime, st.st_size))
+    return l
+
+class IndexCache(object):
+    'size-bounded LRU cache, e.g. of RustIndex objects'
+    def __init__(self, maxsize=20):
+        self.maxsize = maxsize
+        self.d = collections.OrderedDict()
+    def get(self, k):
+        'get cached result, or None if missing'
+        try:
+            result = self.d.pop(k)
+        except KeyError:
+            return None
+        self.d[k] = result # now most recently used
+        return result
+    def set(self, k, result):
+        'save result, evicting least recently used entries if full'
+        self.d.pop(k, None)
+        self.d[k] = result
+        while len(self.d) > self.maxsize:
+            self.d.popitem(last=False)
+    __setitem__ = set
+    def clear(self):
+        self.d.clear()
+
+# process-wide cache shared by all .. select:: directives
+selectIndexCache = IndexCache()
+
+def load_source_path(srcpath, ongoing=[], indexCache=selectIndexCache,
+                     **kwargs):
     srcpath = os.path.abspath(srcpath)
     if srcpath in ongoing:
         print 'WARNING: infinite .. select:: loop blocked:', srcpath
         return None
-    ongoing.append(srcpath) # push onto stack so we can detect infinite loop
-    ## try:
-    ##     return selectIndexCache[srcpath]
-    ## except KeyError:
-    ##     pass
     if os.path.isdir(srcpath): # walk directory for all files
         srcfiles = find_source_files(srcpath, **kwargs)
     else: # single file
         srcfiles = [srcpath]
-    tree = parse_files(srcfiles)
-    ongoing.pop() # all done, so pop from stack
-    d = index_rust(tree)
-    ## selectIndexCache[srcpath] = d
-    return d
+    k = (srcpath, tuple(sorted(kwargs.items())))
+    index = None
+    if indexCache is not None:
+        index = indexCache.get(k)
+    if index is None:
+        index = RustIndex(lazy=lazyParse)
+    ongoing.append(srcpath) # push onto stack so we can detect infinite loop
+    try:
+        index.update(srcfiles, workers=parseWorkers) # only changed files
+    finally:
+        ongoing.pop() # all done, so pop from stack
+    if indexCache is not None:
+        indexCache.set(k, index)
+    return index.d, index.formatDict
 
 def parse_select_item(item):
     'extract item and associated params from text list'
@@ -610,8 +1467,14 @@ def parse_select_item(item):
 def parse_select(rawtext, text, srcpath, filepath, mongoIndex=None,
                  mongoFormats=None):
     'parse a SELECT directive text, return forest of :select: nodes'
-    if srcpath.startswith('http:') or srcpath.startswith('https:'):
-        srcpath = download_file(srcpath) # download local file
+    if srcpath.startswith('sqlite:'): # index saved by sqlitedb.save_index()
+        import sqlitedb
+        srcDict, formatDict = sqlitedb.get_indexes(expand_path(srcpath[7:],
+                                                               filepath))
+        return make_select_nodes(rawtext, text, srcDict, formatDict,
+                                 filepath)
+    if is_url(srcpath):
+        srcpath = download_file(srcpath, downloadCacheDir) # local copy
     else:
         srcpath = expand_path(srcpath, filepath)
     if os.path.isfile(srcpath) and not srcpath.lower().endswith('.rst'):
@@ -625,6 +1488,10 @@ def parse_select(rawtext, text, srcpath, filepath, mongoIndex=None,
         if t is None: # blocked infinite loop, so can't process directive
             return None
         srcDict, formatDict = t
+    return make_select_nodes(rawtext, text, srcDict, formatDict, filepath)
+
+def make_select_nodes(rawtext, text, srcDict, formatDict, filepath):
+    'make a :select: node for each SELECT item, bound to srcDict'
     results = []
     stack = []
     for item in split_items(rawtext, text):
@@ -676,33 +1543,243 @@ def mkdir_if_needed(dirpath):
             raise
 
 
-def convert_to_pdf(srcpath, pdfDir='_converted_pdf',
-                   cmd=['unoconv', '-f', 'pdf']):
-    'convert external format to PDF for pdf page selection'
+# converted PDFs are cached in pdfCacheDir, named by source content hash
+pdfCacheDir = '_converted_pdf'
+convertCmd = ('unoconv', '-f', 'pdf')
+convertWorkers = 4 # max concurrent conversions in process_select()
+
+def get_pdf_path(srcpath, pdfDir=pdfCacheDir, cmd=convertCmd,
+                 blocksize=1<<20):
+    'path of cached PDF for the contents of srcpath, converted by cmd'
+    h = hashlib.sha1(repr(tuple(cmd)))
+    with open(srcpath, 'rb') as ifile:
+        for block in iter(lambda: ifile.read(blocksize), ''):
+            h.update(block)
+    return os.path.join(pdfDir, h.hexdigest() + '.pdf')
+
+def convert_to_pdf(srcpath, pdfDir=pdfCacheDir, cmd=convertCmd):
+    '''convert external format to PDF for pdf page selection, unless
+    a file with the same contents has already been converted'''
+    pdfpath = get_pdf_path(srcpath, pdfDir, cmd)
+    if os.path.isfile(pdfpath):
+        warnings.warn('%s already converted, cached as %s'
+                      % (srcpath, pdfpath))
+        return pdfpath # up to date, no need to do anything
     stem = os.path.basename(srcpath)
     pos = stem.rfind('.')
     if pos >= 0:
         stem = stem[:pos] # remove .suffix from filename
-    pdfpath = os.path.join(pdfDir, stem + '.pdf')
-    if os.path.isfile(pdfpath) and \
-       os.path.getmtime(pdfpath) > os.path.getmtime(srcpath):
-        warnings.warn('%s already converted, cached as %s'
-                      % (srcpath, pdfpath))
-        return pdfpath # up to date, no need to do anything
     mkdir_if_needed(pdfDir)
-    cmd += ['-o', pdfDir, srcpath]
+    outDir = tempfile.mkdtemp(dir=pdfDir) # so same stems cannot collide
+    cmd = list(cmd) + ['-o', outDir, srcpath]
     warnings.warn('Converting %s to PDF; this might take a minute or so...'
                   % srcpath)
     print ' '.join(cmd) # print the command so user can see it...
     try:
-        subprocess.check_call(cmd) # run the conversion
-    except OSError:
         try:
-            os.unlink(pdfpath) # ensure that we don't leave a bad copy
-        except:
-            pass
-        raise OSError('PDF conversion failed: unable to run %s' % cmd[0])
+            subprocess.check_call(cmd) # run the conversion
+        except OSError:
+            raise OSError('PDF conversion failed: unable to run %s' % cmd[0])
+        outpath = os.path.join(outDir, stem + '.pdf')
+        if not os.path.isfile(outpath):
+            raise OSError('PDF conversion failed: %s did not write %s'
+                          % (cmd[0], outpath))
+        os.rename(outpath, pdfpath) # never leaves a partial copy in cache
+    finally:
+        shutil.rmtree(outDir, ignore_errors=True)
     return pdfpath
+
+# downloads are cached in downloadCacheDir/<SHA-1 of URL>/, with the
+# response's validators saved next to the file in a .json file
+downloadCacheDir = '_downloaded'
+downloadWorkers = 4 # max concurrent downloads in process_select()
+validatedURLs = {} # {url:path} checked by the current process_select()
+
+class ConnectionPool(object):
+    '''keep-alive HTTP(S) connections, reused for requests to the
+    same host; each thread gets its own connections'''
+    def __init__(self, timeout=60, maxRedirects=5):
+        self.timeout = timeout
+        self.maxRedirects = maxRedirects
+        self.local = threading.local()
+    def get_connection(self, scheme, netloc):
+        try:
+            conns = self.local.conns
+        except AttributeError:
+            conns = self.local.conns = {}
+        try:
+            return conns[(scheme, netloc)]
+        except KeyError:
+            if scheme == 'https':
+                conn = httplib.HTTPSConnection(netloc, timeout=self.timeout)
+            else:
+                conn = httplib.HTTPConnection(netloc, timeout=self.timeout)
+            conns[(scheme, netloc)] = conn
+            return conn
+    def discard_connection(self, scheme, netloc):
+        conn = getattr(self.local, 'conns', {}).pop((scheme, netloc), None)
+        if conn is not None:
+            conn.close()
+    def send(self, scheme, netloc, path, headers):
+        conn = self.get_connection(scheme, netloc)
+        try:
+            conn.request('GET', path, headers=headers)
+            return conn.getresponse()
+        except (httplib.HTTPException, socket.error):
+            # server may have closed an idle connection: retry once
+            self.discard_connection(scheme, netloc)
+            conn = self.get_connection(scheme, netloc)
+            conn.request('GET', path, headers=headers)
+            return conn.getresponse()
+    def request(self, url, headers={}):
+        '''GET url, following redirects; returns the response, which
+        must be read completely before the next request'''
+        for i in range(self.maxRedirects + 1):
+            parts = urlparse.urlsplit(url)
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+            response = self.send(parts.scheme, parts.netloc, path, headers)
+            location = response.getheader('location')
+            if response.status not in (301, 302, 303, 307, 308) \
+               or not location:
+                return response
+            response.read()
+            url = urlparse.urljoin(url, location)
+        raise IOError('too many redirects: %s' % url)
+
+downloadPool = ConnectionPool()
+
+def get_download_path(url, downloadDir=downloadCacheDir):
+    'cache path for url, keeping its filename (and thus its suffix)'
+    filename = urlparse.urlsplit(url).path.split('/')[-1] or 'index'
+    return os.path.abspath(os.path.join(downloadDir,
+                                        hashlib.sha1(url).hexdigest(),
+                                        filename))
+
+def load_download_info(path):
+    'get dict of validators saved for downloaded file path, or {}'
+    try:
+        with open(path + '.json') as ifile:
+            return json.load(ifile)
+    except (IOError, ValueError):
+        return {}
+
+def download_file(url, downloadDir=downloadCacheDir, pool=None):
+    '''get the specified URL and return the downloaded file path.
+    A cached copy is revalidated using its saved ETag / Last-Modified,
+    and used as is if the server cannot be reached'''
+    try:
+        return validatedURLs[url] # already checked by this process_select
+    except KeyError:
+        pass
+    if pool is None:
+        pool = downloadPool
+    path = get_download_path(url, downloadDir)
+    headers = {}
+    if os.path.isfile(path):
+        info = load_download_info(path)
+        if info.get('etag'):
+            headers['If-None-Match'] = info['etag']
+        if info.get('lastModified'):
+            headers['If-Modified-Since'] = info['lastModified']
+        if not headers: # no way to check it, so assume unchanged
+            warnings.warn('%s already downloaded, cached as %s' % (url, path))
+            validatedURLs[url] = path
+            return path
+    try:
+        response = pool.request(url, headers)
+    except (IOError, httplib.HTTPException):
+        if not headers:
+            raise
+        warnings.warn('cannot check %s, using cached %s' % (url, path))
+        validatedURLs[url] = path
+        return path
+    if response.status == 304: # not modified
+        response.read()
+        warnings.warn('%s not modified, cached as %s' % (url, path))
+        validatedURLs[url] = path
+        return path
+    if response.status != 200:
+        response.read()
+        raise IOError('download of %s failed: HTTP %d %s'
+                      % (url, response.status, response.reason))
+    mkdir_if_needed(os.path.dirname(path))
+    warnings.warn('Downloading %s...' % url)
+    fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as ofile:
+            shutil.copyfileobj(response, ofile) # save the file contents
+        os.rename(tmppath, path) # never leaves a partial copy in cache
+    except BaseException:
+        try:
+            os.unlink(tmppath) # ensure that we don't leave a bad copy
+        except OSError:
+            pass
+        raise
+    with open(path + '.json', 'w') as ofile:
+        json.dump(dict(url=url, etag=response.getheader('etag'),
+                       lastModified=response.getheader('last-modified')),
+                  ofile)
+    validatedURLs[url] = path
+    return path
+
+def get_select_paths(selectFile):
+    'generate source paths of the .. select:: directives in selectFile'
+    for line in split_lines(read_source(selectFile)):
+        line = line.strip()
+        if line.startswith('.. select::'):
+            yield line[11:].strip()
+
+def is_url(srcpath):
+    return srcpath.startswith('http:') or srcpath.startswith('https:')
+
+def prefetch_downloads(selectFile, workers=None):
+    '''download (or revalidate) the http(s) sources of selectFile,
+    up to workers at a time; returns list of downloaded paths'''
+    urls = []
+    for srcpath in get_select_paths(selectFile):
+        if is_url(srcpath) and srcpath not in urls:
+            urls.append(srcpath)
+    return run_threads(lambda url: download_file(url, downloadCacheDir),
+                       urls, workers)
+
+def run_threads(func, args, workers=None):
+    'map func over args, using up to workers threads'
+    if not workers or len(args) < 2:
+        return [func(arg) for arg in args]
+    # threads suffice, since each just waits on I/O or a subprocess
+    pool = multiprocessing.pool.ThreadPool(min(workers, len(args)))
+    try:
+        return pool.map(func, args)
+    finally:
+        pool.close()
+        pool.join()
+    
+def find_file_selects(selectFile):
+    '''get list of local (or already downloaded) non-PDF files that
+    the .. select:: directives of selectFile will convert to PDF'''
+    srcpaths = []
+    for srcpath in get_select_paths(selectFile):
+        if srcpath.startswith('sqlite:'):
+            continue
+        if is_url(srcpath):
+            srcpath = get_download_path(srcpath, downloadCacheDir)
+        else:
+            srcpath = expand_path(srcpath, selectFile)
+        if os.path.isfile(srcpath) and srcpath not in srcpaths and \
+           not srcpath.lower().endswith('.rst') and \
+           not srcpath.lower().endswith('.pdf'):
+            srcpaths.append(srcpath)
+    return srcpaths
+
+def convert_file_selects(selectFile, workers=None):
+    '''convert the files selected by selectFile to PDF before parsing
+    it, running up to workers conversions at a time; returns list
+    of PDF paths'''
+    return run_threads(lambda srcpath: convert_to_pdf(srcpath, pdfCacheDir,
+                                                      convertCmd),
+                       find_file_selects(selectFile), workers)
     
 def parse_pdf_select(rawtext, text, srcpath, filepath,
                      formatDict=includePDFformats):
@@ -717,80 +1794,159 @@ def parse_pdf_select(rawtext, text, srcpath, filepath,
         results.append(node)
     return results
 
-def download_file(url, downloadDir='_downloaded'):
-    'get the specified URL and return the downloaded file path'
-    path = os.path.join(downloadDir, url.split('/')[-1])
-    path = os.path.abspath(path)
-    if os.path.isfile(path): # already downloaded, nothing to do
-        warnings.warn('%s already downloaded, cached as %s' % (url, path))
-        return path
-    mkdir_if_needed(downloadDir)
-    warnings.warn('Downloading %s...' % url)
-    req = urllib2.urlopen(url)
-    try:
-        with open(path, 'wb') as ifile:
-            shutil.copyfileobj(req, ifile) # save the file contents
-    except BaseException as e: # catch all possible errors
-        try:
-            os.unlink(path) # ensure that we don't leave a bad copy
-        except:
-            pass
-        raise e # report the original error
-    return path
-    
-
 def parse_file_select(rawtext, text, srcpath, filepath):
     'toplevel fileselect dispatcher'
     if not srcpath.lower().endswith('.pdf'):
-        srcpath = convert_to_pdf(srcpath) # try to convert to PDF
+        srcpath = convert_to_pdf(srcpath, pdfCacheDir, convertCmd)
     return parse_pdf_select(rawtext, text, srcpath, filepath)
 
+# select expressions: ID, [expr,expr...] or (key=expr,key2=expr...)
+selectIDRE = re.compile(r'[^\[\](),=]+')
+selectKeyRE = re.compile(r'([^\[\](),=]+)=')
+selectFlatListRE = re.compile(r'\[([^\[\](),=]+(?:,[^\[\](),=]+)*)\]')
+
+def parse_select_expr(s):
+    '''parse select expression s in one pass, returning (ast, ids, end):
+    ast is ('id', ID), ('ids', [ID,...]) for a list of IDs only,
+    ('list', [ast,...]) or ('dict', [(key, ast),...]); ids lists its
+    IDs in order, and end is the length of s that the expression spans'''
+    ids = []
+    def parse_value(i):
+        m = selectFlatListRE.match(s, i)
+        if m: # the usual case, so split it all at once
+            l = m.group(1).split(',')
+            ids.extend(l)
+            return ('ids', l), m.end()
+        c = s[i:i + 1]
+        if c == '[':
+            return parse_items(i + 1, ']', False)
+        if c == '(':
+            return parse_items(i + 1, ')', True)
+        m = selectIDRE.match(s, i)
+        if not m:
+            raise ValueError('expected ID, [ or ( at %d in select '
+                             'expression: %s' % (i, s))
+        ids.append(m.group())
+        return ('id', m.group()), m.end()
+    def parse_items(i, close, isDict):
+        items = []
+        if s[i:i + 1] == close: # empty
+            return ('dict' if isDict else 'list', items), i + 1
+        while True:
+            if isDict:
+                m = selectKeyRE.match(s, i)
+                if not m:
+                    raise ValueError('missing key= in select-dict: ' + s)
+                value, i = parse_value(m.end())
+                items.append((m.group(1), value))
+            else:
+                value, i = parse_value(i)
+                items.append(value)
+            c = s[i:i + 1]
+            if c == close:
+                return ('dict' if isDict else 'list', items), i + 1
+            if not c:
+                raise ValueError('incomplete select expression: ' + s)
+            if c != ',':
+                raise ValueError('missing comma in select expression: ' + s)
+            i += 1
+    ast, end = parse_value(0)
+    return ast, ids, end
+
+# parsed select expressions, shared by all srcDicts
+selectExprCache = IndexCache(1000)
+
+def get_select_expr(s):
+    'cached parse_select_expr(s)'
+    t = selectExprCache.get(s)
+    if t is None:
+        t = parse_select_expr(s)
+        selectExprCache.set(s, t)
+    return t
+
+def lookup_ids(ids, srcDict):
+    '''get {ID:node} for ids, fetched in one batch if srcDict supports
+    it (e.g. mongo.DocIDIndex); otherwise just srcDict itself'''
+    try:
+        get_many = srcDict.get_many
+    except AttributeError:
+        return srcDict # looking up each ID is as fast as it gets
+    unique = []
+    seen = set()
+    for sourceID in ids:
+        if sourceID not in seen:
+            seen.add(sourceID)
+            unique.append(sourceID)
+    return dict(zip(unique, get_many(unique)))
+
+def build_select_value(ast, nodes):
+    'replace the IDs in ast by their nodes'
+    kind, v = ast
+    if kind == 'id':
+        return nodes[v]
+    if kind == 'ids':
+        return [nodes[k] for k in v]
+    if kind == 'list':
+        return [build_select_value(item, nodes) for item in v]
+    return dict([(k, build_select_value(item, nodes)) for k, item in v])
+
+def eval_select_expr(s, srcDict):
+    'get (kind, value) of select expression s, and the length it spans'
+    ast, ids, end = get_select_expr(s)
+    kind = 'dict' if ast[0] == 'dict' else 'list'
+    return kind, build_select_value(ast, lookup_ids(ids, srcDict)), end
+
 def parse_select_list(s, srcDict):
     'extract [ID1,ID2...] list starting at this point, or return None'
-    if s[0] == '[': # start of a list
-        sources = []
-        for sourceID in s[1:].split(']')[0].split(','):
-            sources.append(srcDict[sourceID])
-        return sources, s.index(']') + 1
+    if s[:1] == '[': # start of a list
+        return eval_select_expr(s, srcDict)[1:]
 
 def parse_select_dict(s, srcDict):
     'extract {key=EXPR,key2=EXPR...} starting at this point, or return None'
-    if s[0] == '(': # start of a dict
-        d = {}
-        start = 0
-        tokens = s[1:].split(')')[0].split('=')
-        for i,k in enumerate(tokens[:-1]):
-            k = k[start:]
-            t = parse_select_list(tokens[i + 1], srcDict)
-            if t: # save select-list record
-                d[k] = t[0]
-                if t[1] < len(tokens[i + 1]) and tokens[i + 1][t[1]] != ',':
-                    raise ValueError('missing comma in select-dict')
-                start = t[1] + 1 # skip past the comma
-            else: # treat as single ID
-                sourceID = tokens[i + 1].split(',')[0]
-                d[k] = srcDict[sourceID]
-                start = len(sourceID) + 1 # skip past the comma
-        return d, s.index(')') + 1
-                
-        
+    if s[:1] == '(': # start of a dict
+        return eval_select_expr(s, srcDict)[1:]
+
+def resolve_select(sourceID, srcDict):
+    '''get ('dict', {key:nodes}), ('list', nodes) or ('node', node) for a
+    :select: sourceID expression.  Results are memoized in
+    srcDict.selectMemo (a dict, or a size-bounded IndexCache),
+    which RustIndex.update() resets'''
+    try:
+        memo = srcDict.selectMemo
+    except AttributeError:
+        memo = {}
+        try:
+            srcDict.selectMemo = memo
+        except AttributeError: # e.g. a plain dict, so just don't save
+            pass
+    result = memo.get(sourceID) # memo may be a dict or an IndexCache
+    if result is not None:
+        return result
+    if sourceID[:1] in ('[', '('): # a list or dict of source nodes
+        kind, value, end = eval_select_expr(sourceID, srcDict)
+        if end < len(sourceID):
+            raise ValueError('unexpected text after select expression: '
+                             + sourceID)
+        result = (kind, value)
+    else: # single ID node
+        result = ('node', srcDict[sourceID])
+    memo[sourceID] = result
+    return result
+
 def apply_select(tree):
     'replace :select: nodes with desired content from node.srcDict'
     for i,node in enumerate(tree.children):
         if node.tokens[0] == ':select:':
-            t = parse_select_dict(node.sourceID, node.srcDict)
-            if t: # save a dict of source nodes
-                node.selectParams.update(t[0])
-            else:
-                t = parse_select_list(node.sourceID, node.srcDict)
-                if t: # save a list of source nodes
-                    node.selectParams['sources'] = t[0]
-                else: # single ID node
-                    sourceNode = node.srcDict[node.sourceID]
-                    c = sourceNode.copy()
-                    c.selectParams = node.selectParams
-                    c.formatDict = node.formatDict
-                    tree.children[i] = c # source node replaces target node
+            kind, result = resolve_select(node.sourceID, node.srcDict)
+            if kind == 'dict': # save a dict of source nodes
+                node.selectParams.update(result)
+            elif kind == 'list': # save a list of source nodes
+                node.selectParams['sources'] = result
+            else: # single ID node
+                c = result.share()
+                c.selectParams = node.selectParams
+                c.formatDict = node.formatDict
+                tree.children[i] = c # source node replaces target node
         else: # recurse down tree
             apply_select(node)
 
@@ -810,6 +1966,72 @@ def directive(name, v, text):
         return indented('.. ', '%s:: %s\n\n%s' % (name, v, text))
 
 
+# globals available to every format template
+renderGlobals = dict(indented=indented, directive=directive,
+                     getattr=getattr, len=len, int=int)
+
+class TemplateCache(object):
+    '''compiled templates keyed by hash of their source, all in one
+    Environment with renderGlobals.  If bytecodeDir is set, jinja2 also
+    saves their compiled bytecode there, so other processes can skip
+    compiling them'''
+    def __init__(self, bytecodeDir=None):
+        self.bytecodeDir = bytecodeDir
+        self.d = {}
+        self.sources = {} # for jinja2 loader
+        self.env = None
+        self.envDir = None # bytecodeDir that self.env was made for
+        self.lock = threading.Lock() # compiles share self.sources
+    def get(self, s):
+        'get compiled Template for template source string s'
+        if isinstance(s, unicode):
+            k = hashlib.sha1(s.encode('utf-8')).hexdigest()
+        else:
+            k = hashlib.sha1(s).hexdigest()
+        try:
+            return self.d[k]
+        except KeyError:
+            pass
+        with self.lock: # one thread at a time compiles
+            try:
+                return self.d[k] # another thread just compiled it
+            except KeyError:
+                pass
+            env = self.get_env()
+            if self.bytecodeDir: # load via the bytecode cache
+                self.sources[k] = s
+                try:
+                    t = env.get_template(k)
+                finally:
+                    del self.sources[k]
+            else:
+                t = env.from_string(s)
+            self.d[k] = t
+        return t
+    def get_env(self):
+        'jinja2 Environment, using the bytecode cache if bytecodeDir set'
+        if self.env is None or self.envDir != self.bytecodeDir:
+            bytecodeCache = None
+            if self.bytecodeDir:
+                mkdir_if_needed(self.bytecodeDir)
+                bytecodeCache = FileSystemBytecodeCache(self.bytecodeDir)
+            self.env = Environment(loader=FunctionLoader(self.sources.get),
+                                   bytecode_cache=bytecodeCache,
+                                   cache_size=0)
+            self.env.globals.update(renderGlobals)
+            self.envDir = self.bytecodeDir
+        return self.env
+    def clear(self):
+        self.d.clear()
+
+# process-wide template cache; set templateCache.bytecodeDir to also
+# keep compiled bytecode on disk
+templateCache = TemplateCache()
+
+def compile_template(s):
+    'get compiled Template for source s from templateCache'
+    return templateCache.get(s)
+
 def read_formats(filename):
     'get format dictionary from the RUsT file'
     tree = parse_file(filename)
@@ -817,8 +2039,7 @@ def read_formats(filename):
     for node in tree.walk():
         if getattr(node, 'tokens', ('ignore',))[0] == ':format:':
             s = '\n'.join(node.text)
-            t = Template(s)
-            formatDict[node.tokens[1]] = t
+            formatDict[node.tokens[1]] = compile_template(s)
     return formatDict
 
 def itemsplit_pp(node, rawtext):
@@ -840,51 +2061,112 @@ def multichoice_pp(node, rawtext):
             break
     return items
 
-def process_select(selectFile):
-    'read RUsT containing SELECT statements, process them'
+def process_select(selectFile, revalidate=True):
+    '''read RUsT containing SELECT statements, process them.
+    If revalidate is False, downloads already checked in this run
+    (e.g. by build.plan_graph()) are not checked again'''
+    if revalidate:
+        validatedURLs.clear() # revalidate downloads once per run
+    prefetch_downloads(selectFile, downloadWorkers) # in parallel
+    convert_file_selects(selectFile, convertWorkers)
     selection = parse_file(selectFile)
     apply_select(selection)
     return selection
 
 
+class TextRenderer(object):
+    '''extracts text from a tree in one pass, applying bound templates.
+    Metadata attrs are added only once per node, and the template
+    globals (renderGlobals) are bound once, in templateCache's
+    Environment, rather than passed to every render() call'''
+    def __init__(self, postprocDict, **kwargs):
+        self.postprocDict = postprocDict
+        self.kwargs = kwargs
+        self.attrsDone = {} # {id(node):node} already given metadata attrs
+    def add_metadata_attrs(self, node):
+        if id(node) not in self.attrsDone:
+            node.add_metadata_attrs(self.postprocDict)
+            self.attrsDone[id(node)] = node
+    def get_text_select(self, node):
+        'get template formatted text from :select: node'
+        self.add_metadata_attrs(node)
+        for c in node.children:
+            self.add_metadata_attrs(c)
+        nodeParams = self.kwargs.copy()
+        nodeParams.update(node.selectParams)
+        try:
+            formatID = nodeParams['format']
+        except KeyError:
+            return getattr(node, 'text', [])
+        t = node.formatDict[formatID]
+        if 'indented' in t.globals: # compiled by templateCache
+            d = nodeParams.copy()
+        else: # have to pass the globals ourselves
+            d = renderGlobals.copy()
+            d.update(nodeParams)
+        d['this'] = node
+        d['children'] = node.children
+        d['kwargs'] = nodeParams
+        return [t.render(d)]
+    def iter_text(self, tree):
+        '''generate text lines (or rendered template strings)
+        of tree.children, in document order'''
+        stack = [iter(tree.children)]
+        while stack:
+            for node in stack[-1]:
+                if hasattr(node, 'selectParams'):
+                    for s in self.get_text_select(node):
+                        yield s
+                else:
+                    title = getattr(node, 'title', (None,))[0]
+                    if title: # add reST title
+                        yield title
+                        yield '-' * len(title)
+                    for s in getattr(node, 'text', []):
+                        yield s
+                    stack.append(iter(node.children)) # descend into node
+                    break
+            else: # finished these children
+                stack.pop()
+
 def get_text_select(node, postprocDict, **kwargs):
     'get template formatted text from :select: node'
-    node.add_metadata_attrs(postprocDict)
-    for c in node.children:
-        c.add_metadata_attrs(postprocDict)
-    nodeParams = kwargs.copy()
-    nodeParams.update(node.selectParams)
-    try:
-        formatID = nodeParams['format']
-    except KeyError:
-        return getattr(node, 'text', [])
-    t = node.formatDict[formatID]
-    s = t.render(this=node, children=node.children,
-                 indented=indented, directive=directive,
-                 getattr=getattr, len=len, int=int,
-                 kwargs=nodeParams, **nodeParams)
-    return [s]
+    return TextRenderer(postprocDict, **kwargs).get_text_select(node)
 
 def get_text_list(tree, postprocDict, **kwargs):
     'walk tree and extract text, applying bound templates'
-    l = []
-    for node in tree.children:
-        if hasattr(node, 'selectParams'):
-            l += get_text_select(node, postprocDict, **kwargs)
-        else:
-            title = getattr(node, 'title', (None,))[0]
-            if title: # add reST title
-                l += [title, '-' * len(title)]
-            l += getattr(node, 'text', [])
-            l += get_text_list(node, postprocDict, **kwargs)
-    return l
+    return list(TextRenderer(postprocDict, **kwargs).iter_text(tree))
 
 # define metadata that require post-processing
 PostprocDict = {'multichoice':multichoice_pp}
 
+def iter_text(tree, postprocDict=PostprocDict, **kwargs):
+    'generate the lines that get_text() joins'
+    return TextRenderer(postprocDict, **kwargs).iter_text(tree)
+
 def get_text(tree, postprocDict=PostprocDict, **kwargs):
-    l = get_text_list(tree, postprocDict, **kwargs)
-    return u'\n'.join(l)
+    return u'\n'.join(iter_text(tree, postprocDict, **kwargs))
+
+# number of lines that write_text() joins per write() call
+writeChunkLines = 1000
+
+def write_text(tree, ofile, postprocDict=PostprocDict, **kwargs):
+    '''write get_text() output to file object ofile, a chunk of lines
+    at a time, without building the whole text in memory'''
+    write_lines(iter_text(tree, postprocDict, **kwargs), ofile)
+
+def write_lines(lines, ofile):
+    'write lines joined by newlines to ofile, writeChunkLines at a time'
+    l = []
+    sep = u''
+    for s in lines:
+        l.append(s)
+        if len(l) >= writeChunkLines:
+            ofile.write(sep + u'\n'.join(l))
+            sep = u'\n'
+            l = []
+    if l:
+        ofile.write(sep + u'\n'.join(l))
 
 if __name__ == '__main__':
     import sys
@@ -893,5 +2175,5 @@ if __name__ == '__main__':
     except ValueError:
         print 'usage: %s INRSTFILE OUTRSTFILE' % sys.argv[0]
     tree = process_select(infile)
-    with open(outfile, 'w') as ofile:
-        ofile.write(get_text(tree))
+    with codecs.open(outfile, 'w', encoding='utf-8') as ofile:
+        write_text(tree, ofile)
@@ -0,0 +1,163 @@
+import parse
+import re
+import sys
+import math
+import sqlite3
+
+# same field weights as mongo.init_collection() text index
+fieldWeights = dict(title=10, content=1)
+
+# BM25 parameters
+bm25K1 = 1.2
+bm25B = 0.75
+
+wordRE = re.compile(r'\w+', re.UNICODE)
+
+schema = '''
+CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, mtime REAL,
+                                  size INTEGER);
+CREATE TABLE IF NOT EXISTS docs (id INTEGER PRIMARY KEY, path TEXT,
+                                 title TEXT, length REAL, state BLOB);
+CREATE INDEX IF NOT EXISTS docs_path ON docs (path);
+CREATE TABLE IF NOT EXISTS postings (term TEXT, doc INTEGER, tf REAL);
+CREATE INDEX IF NOT EXISTS postings_term ON postings (term);
+CREATE INDEX IF NOT EXISTS postings_doc ON postings (doc);
+'''
+
+def extract_docs(node, level=1):
+    '''get list of (doc, children) for the same sections and questions
+    that mongo.extract_docs() saves, without removing questions from
+    their section: children are the nodes whose text belongs to doc'''
+    if getattr(node, 'level', 0) < level:
+        l = []
+        for c in node.children:
+            l += extract_docs(c, level)
+        return l
+    l = []
+    children = []
+    for c in node.children:
+        if getattr(c, 'tokens', ('mismatch',))[0] == ':question:':
+            l.append((c, c.children))
+        else:
+            children.append(c)
+    l.append((node, children))
+    return l
+
+def combine_text(node, children):
+    'combine text lists from node and children subtrees'
+    l = list(getattr(node, 'text', ()))
+    for c in children:
+        l += combine_text(c, c.children)
+    return l
+
+def get_title(doc):
+    'title attr or metadata, as for mongo.jsonize_docs()'
+    try:
+        return '\n'.join(doc.title)
+    except AttributeError:
+        return '\n'.join(doc.metadata_dict().get('title', ()))
+
+def get_terms(s):
+    'split text into lowercase search terms'
+    return wordRE.findall(s.lower())
+
+class SearchIndex(object):
+    '''BM25 full-text index of the title and text of parsed docs,
+    saved in an sqlite file; an offline alternative to
+    mongo.text_search()'''
+    def __init__(self, dbpath):
+        self.conn = sqlite3.connect(dbpath)
+        self.conn.text_factory = unicode
+        self.conn.executescript(schema)
+    def update(self, srcfiles):
+        '''re-index files that were added, removed or changed since
+        the last update; return list of re-indexed files'''
+        stamps = parse.get_file_stamps(srcfiles)
+        saved = dict((t[0], t[1:]) for t in self.conn.execute(
+            'SELECT path, mtime, size FROM files'))
+        changed = [t for t in stamps if saved.pop(t[0], None) != t[1:]]
+        with self.conn:
+            for path in saved: # no longer in srcfiles
+                self.remove_file(path)
+            for path, mtime, size in changed:
+                self.add_tree(path, parse.parse_file(path))
+                self.conn.execute('INSERT INTO files VALUES (?, ?, ?)',
+                                  (path, mtime, size))
+        return [t[0] for t in changed]
+    def remove_file(self, path):
+        'drop docs of file path from the index'
+        self.conn.execute('DELETE FROM postings WHERE doc IN '
+                          '(SELECT id FROM docs WHERE path=?)', (path,))
+        self.conn.execute('DELETE FROM docs WHERE path=?', (path,))
+        self.conn.execute('DELETE FROM files WHERE path=?', (path,))
+    def add_tree(self, path, tree):
+        'index the docs of tree, replacing any saved for path'
+        self.remove_file(path)
+        for doc, children in extract_docs(tree):
+            title = get_title(doc)
+            tf = {}
+            length = 0
+            for field, s in (('title', title),
+                             ('content',
+                              '\n'.join(combine_text(doc, children)))):
+                weight = fieldWeights[field]
+                for term in get_terms(s):
+                    tf[term] = tf.get(term, 0) + weight
+                    length += weight
+            state = parse.encode_trees([doc])
+            docID = self.conn.execute(
+                'INSERT INTO docs (path, title, length, state) '
+                'VALUES (?, ?, ?, ?)',
+                (path, title, length, sqlite3.Binary(state))).lastrowid
+            self.conn.executemany('INSERT INTO postings VALUES (?, ?, ?)',
+                                  [(term, docID, v) for term, v in tf.items()])
+    def search(self, query, limit=50):
+        'get list of (node, score) best matching query, best first'
+        n, avgLength = self.conn.execute(
+            'SELECT COUNT(*), AVG(length) FROM docs').fetchone()
+        if not n:
+            return []
+        scores = {}
+        for term in set(get_terms(query)):
+            rows = self.conn.execute(
+                'SELECT p.doc, p.tf, d.length FROM postings p '
+                'JOIN docs d ON p.doc = d.id WHERE p.term=?',
+                (term,)).fetchall()
+            if not rows:
+                continue
+            idf = math.log(1. + (n - len(rows) + 0.5) / (len(rows) + 0.5))
+            for docID, tf, length in rows:
+                norm = bm25K1 * (1. - bm25B + bm25B * length / avgLength)
+                scores[docID] = scores.get(docID, 0.) \
+                                + idf * tf * (bm25K1 + 1.) / (tf + norm)
+        best = sorted(scores.items(), key=lambda t:t[1], reverse=True)[:limit]
+        l = []
+        for docID, score in best:
+            state = self.conn.execute('SELECT state FROM docs WHERE id=?',
+                                      (docID,)).fetchone()[0]
+            node = parse.decode_trees(str(state))[0]
+            l.append((node, score))
+        return l
+    def close(self):
+        self.conn.close()
+
+def text_search(dbpath, query, limit=50):
+    'search index file dbpath, returning list of (node, score)'
+    index = SearchIndex(dbpath)
+    try:
+        return index.search(query, limit)
+    finally:
+        index.close()
+
+if __name__ == '__main__':
+    try:
+        srcpath, dbpath = sys.argv[1:3]
+    except ValueError:
+        print 'usage: %s SRCPATH DBFILE [QUERY]' % sys.argv[0]
+    else:
+        index = SearchIndex(dbpath)
+        index.update(parse.find_source_files(srcpath))
+        for node, score in index.search(' '.join(sys.argv[3:])):
+            print '%.3f %s %s' % (score, getattr(node, 'tokens', ('',))[-1],
+                                  get_title(node).encode('utf-8'))
+        index.close()
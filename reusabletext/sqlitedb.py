@@ -0,0 +1,170 @@
+import parse
+import os
+import sys
+import sqlite3
+
+schema = '''
+CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, mtime REAL,
+                                  size INTEGER, hash TEXT);
+CREATE TABLE IF NOT EXISTS nodes (id TEXT PRIMARY KEY, kind TEXT,
+                                  path TEXT, start INTEGER, stop INTEGER,
+                                  hash TEXT, state BLOB);
+CREATE TABLE IF NOT EXISTS formats (id TEXT PRIMARY KEY, template TEXT);
+'''
+
+def connect(dbpath):
+    'open sqlite index file, creating its tables if needed'
+    conn = sqlite3.connect(dbpath)
+    conn.text_factory = unicode
+    conn.executescript(schema)
+    return conn
+
+def get_line_range(node):
+    '''get (start, stop) rawtext line range spanned by the text of node
+    and its descendants, or (None, None) if not known'''
+    start = stop = None
+    for n in node.walk():
+        text = getattr(n, '_text', None)
+        if isinstance(text, parse.TextLines) and text.runs:
+            if start is None or text.runs[0][0] < start:
+                start = text.runs[0][0]
+            if stop is None or text.runs[-1][1] > stop:
+                stop = text.runs[-1][1]
+    return start, stop
+
+def extract_formats(tree, d=None):
+    'get dict of named template strings'
+    if d is None:
+        d = {}
+    for node in tree.walk():
+        tokens = getattr(node, 'tokens', ())
+        if len(tokens) >= 2 and tokens[0] == ':format:':
+            d[tokens[1]] = '\n'.join(node.text)
+    return d
+
+def save_index(dbpath, srcfiles):
+    '''save index_rust() of the source files to sqlite file dbpath,
+    unless it is already up to date.  Returns True if (re)written.
+    Files are parsed without the parse cache, since only a fresh parse
+    knows the line ranges of its nodes'''
+    stamps = parse.get_file_stamps(srcfiles)
+    conn = connect(dbpath)
+    try:
+        saved = conn.execute('SELECT path, mtime, size FROM files '
+                             'ORDER BY rowid').fetchall()
+        if saved == stamps:
+            return False # no changes
+        d = parse.MultiDict()
+        formats = {}
+        nodeFiles = {} # {id(node):(path, hash)}
+        fileRows = []
+        for path, mtime, size in stamps:
+            source = parse.read_source(path)
+            h = parse.get_content_hash(source)
+            tree = parse.parse_text(source, path, None, cacheDir=None)
+            fileRows.append((path, mtime, size, h))
+            for k, node in parse.generate_index_entries(tree, {}):
+                d[k] = node
+                nodeFiles[id(node)] = (path, h)
+            extract_formats(tree, formats)
+        with conn: # replace everything in one transaction
+            conn.execute('DELETE FROM files')
+            conn.execute('DELETE FROM nodes')
+            conn.execute('DELETE FROM formats')
+            conn.executemany('INSERT INTO files VALUES (?, ?, ?, ?)',
+                             fileRows)
+            conn.executemany('INSERT INTO nodes VALUES (?, ?, ?, ?, ?, ?, ?)',
+                             generate_node_rows(d, nodeFiles))
+            conn.executemany('INSERT INTO formats VALUES (?, ?)',
+                             formats.items())
+    finally:
+        conn.close()
+    return True
+
+def generate_node_rows(d, nodeFiles):
+    for k, node in d.items():
+        path, h = nodeFiles[id(node)]
+        start, stop = get_line_range(node)
+        state = parse.encode_trees([node])
+        yield (k, node.tokens[0], path, start, stop, h,
+               sqlite3.Binary(state))
+
+def save_source_path(dbpath, srcpath):
+    'save index of srcpath (directory or single file) to dbpath'
+    srcpath = os.path.abspath(srcpath) # same paths as load_source_path()
+    if os.path.isdir(srcpath):
+        srcfiles = parse.find_source_files(srcpath)
+    else:
+        srcfiles = [srcpath]
+    return save_index(dbpath, srcfiles)
+
+
+class SqliteIDIndex(object):
+    'dict interface to the nodes saved by save_index()'
+    def __init__(self, dbpath=None, conn=None):
+        if conn is None:
+            conn = connect(dbpath)
+        self.conn = conn
+    def __getitem__(self, k):
+        row = self.conn.execute('SELECT state FROM nodes WHERE id=?',
+                                (k,)).fetchone()
+        if row is None:
+            raise KeyError('ID %s not found' % k)
+        return parse.decode_trees(str(row[0]))[0]
+    def __contains__(self, k):
+        return self.conn.execute('SELECT 1 FROM nodes WHERE id=?',
+                                 (k,)).fetchone() is not None
+    def get_info(self, k):
+        'get (kind, path, start, stop, hash) saved for ID k'
+        row = self.conn.execute('SELECT kind, path, start, stop, hash '
+                                'FROM nodes WHERE id=?', (k,)).fetchone()
+        if row is None:
+            raise KeyError('ID %s not found' % k)
+        return tuple(row)
+
+class SqliteFormatIndex(object):
+    'dict interface to the formats saved by save_index()'
+    def __init__(self, dbpath=None, conn=None):
+        if conn is None:
+            conn = connect(dbpath)
+        self.conn = conn
+    def __getitem__(self, k):
+        row = self.conn.execute('SELECT template FROM formats WHERE id=?',
+                                (k,)).fetchone()
+        if row is None:
+            raise KeyError('ID %s not found' % k)
+        return parse.compile_template(row[0])
+
+
+# {dbpath:(stamp, indexes)}, so that select results memoized on an
+# index (parse.resolve_select()) are reused until the file changes
+openIndexes = {}
+
+def get_indexes(dbpath):
+    'get doc and format index interfaces to the sqlite file'
+    dbpath = os.path.abspath(dbpath)
+    stamp = parse.get_file_stamps([dbpath])[0] if os.path.exists(dbpath) \
+            else None
+    try:
+        oldStamp, indexes = openIndexes[dbpath]
+    except KeyError:
+        pass
+    else:
+        if oldStamp == stamp:
+            return indexes
+        indexes[0].conn.close()
+    conn = connect(dbpath)
+    indexes = SqliteIDIndex(conn=conn), SqliteFormatIndex(conn=conn)
+    openIndexes[dbpath] = (parse.get_file_stamps([dbpath])[0], indexes)
+    return indexes
+
+if __name__ == '__main__':
+    try:
+        srcpath, dbpath = sys.argv[1:]
+    except ValueError:
+        print 'usage: %s SRCPATH DBFILE' % sys.argv[0]
+    else:
+        if save_source_path(dbpath, srcpath):
+            print 'saved', dbpath
+        else:
+            print dbpath, 'is up to date'
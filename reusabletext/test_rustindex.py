@@ -0,0 +1,59 @@
+import parse
+import os
+import shutil
+import tempfile
+import unittest
+
+sectionText = u'''Section %(n)s
+=========
+
+:ID: %(id)s
+
+Some text.
+'''
+
+brokenText = sectionText + u'''
+.. glossary::
+
+'''
+
+class RustIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.dirpath = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.dirpath) # keep its parse cache out of the tree
+        self.srcfiles = [os.path.join(self.dirpath, 'a.rst'),
+                         os.path.join(self.dirpath, 'b.rst')]
+        self.write(1, sectionText, id='other')
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dirpath)
+    def write(self, i, text, **kwargs):
+        kwargs.setdefault('n', i)
+        with open(self.srcfiles[i], 'w') as ofile:
+            ofile.write((text % kwargs).encode('utf-8'))
+    def check_fresh(self, index):
+        'index must match a fresh index_rust() of the same files'
+        d, formatDict = parse.index_rust(parse.parse_files(self.srcfiles,
+                                                           cacheDir=None))
+        self.assertEqual(sorted(index.d.keys()), sorted(d.keys()))
+        self.assertEqual(sorted(index.formatDict), sorted(formatDict))
+    def run_failed_update(self, lazy):
+        index = parse.RustIndex(lazy)
+        self.write(0, sectionText, id='old')
+        index.update(self.srcfiles)
+        self.check_fresh(index)
+        self.write(0, brokenText, id='broken_edit')
+        if not lazy: # scan_rust() only finds the error when parsing
+            self.assertRaises(ValueError, index.update, self.srcfiles)
+        self.write(0, sectionText, id='new_id_with_a_longer_name')
+        index.update(self.srcfiles)
+        self.check_fresh(index)
+    def test_failed_update(self):
+        'a parse error leaves no stale keys once the file is fixed'
+        self.run_failed_update(False)
+    def test_failed_update_lazy(self):
+        self.run_failed_update(True)
+
+if __name__ == '__main__':
+    unittest.main()
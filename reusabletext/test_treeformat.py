@@ -0,0 +1,113 @@
+import parse
+import benchmark
+import jsonpickle
+import unittest
+
+sampleText = u'''Probability Basics
+==================
+
+:ID: prob_basics
+:conceptID: Probability
+:title: Probability Basics
+
+Caf\xe9 na\xefve text, with math :math:`\u03ba=0,1,...2N`.
+
+:question: snp_detection_prob
+  :title: A SNP Detection Problem
+  :tests: Projection_(statistics)
+  Can you compute the posterior odds ratio?
+  :multichoice:
+    * Yes, the data are sufficient. :correct:
+    * No, the :math:`\u03ba` values are unknown.
+  :answer:
+    Yes, just sum over all possible values of :math:`\u03ba`.
+  :error:
+    The :math:`\u03ba` values must be known.
+  :error:
+    The prior ratio is not needed.
+
+:question: second_question
+  Which of these is a hidden variable?
+  :multichoice:
+    * The observation :math:`X`.
+    * The number of copies :math:`\u03ba`. :correct:
+  :answer:
+    :math:`\u03ba`, since it is never observed.
+
+Summation Principle
+-------------------
+
+.. glossary::
+
+   hidden variable
+     a variable whose value is not observed.
+
+   \xfcber term
+     a term with non-ASCII text.
+'''
+
+def tree_state(node):
+    '''nested __getstate__() of subtree, plus the attrs that metadata
+    postprocessing added, for comparing whole trees'''
+    d = node.__getstate__()
+    d['class'] = node.__class__.__name__
+    d['attrs'] = dict([(k, v) for k, v in getattr(node, '__dict__', {}).items()
+                       if k != 'glossary'])
+    d['text'] = list(d['text'])
+    d['children'] = [tree_state(c) for c in d['children']]
+    if 'glossary' in d:
+        d['glossary'] = [tree_state(c) for c in d['glossary']]
+    return d
+
+def get_corpus():
+    'list of (name, source text) pairs, as unicode and str'
+    writer = benchmark.CorpusWriter(**benchmark.corpusParams)
+    l = [('sample.rst', sampleText),
+         ('sample_str.rst', sampleText.encode('ascii', 'replace'))]
+    for i in range(3):
+        s = writer.file_text(i)
+        l.append(('file%d.rst' % i, unicode(s)))
+        l.append(('file%d_str.rst' % i, str(s)))
+    return l
+
+class TreeFormatTest(unittest.TestCase):
+    def test_matches_jsonpickle(self):
+        'decode_trees(encode_trees()) gives the same trees as jsonpickle'
+        for name, s in get_corpus():
+            nodes = parse.parse_text(s, name, None, cacheDir=None).children
+            decoded = parse.decode_trees(parse.encode_trees(nodes),
+                                         parse.PostprocDict)
+            unpickled = jsonpickle.decode(jsonpickle.encode(nodes))
+            self.assertEqual([tree_state(n) for n in decoded],
+                             [tree_state(n) for n in unpickled], name)
+    def test_postproc_attrs(self):
+        'decode_trees() with PostprocDict adds the postprocessed attrs'
+        nodes = parse.parse_text(sampleText, 'sample.rst', None,
+                                 cacheDir=None).children
+        decoded = parse.decode_trees(parse.encode_trees(nodes),
+                                     parse.PostprocDict)
+        questions = [n for n in decoded[0].walk()
+                     if n.tokens[0] == ':question:']
+        self.assertEqual([q.correct for q in questions], [0, 1])
+        q = questions[0]
+        self.assertEqual(len(q.multichoice[0]), 2)
+        self.assertEqual(q.multichoice[0][0],
+                         [u'Yes, the data are sufficient. '])
+        self.assertEqual(len(q.answer), 1)
+        self.assertEqual(len(q.error), 2)
+    def test_keeps_string_types(self):
+        'str and unicode text keep their type, unlike a JSON round trip'
+        for name, s in get_corpus():
+            nodes = parse.parse_text(s, name, None, cacheDir=None).children
+            decoded = parse.decode_trees(parse.encode_trees(nodes))
+            for node, node2 in zip(nodes, decoded):
+                for n, n2 in zip(node.walk(), node2.walk()):
+                    self.assertEqual([type(t) for t in n.tokens],
+                                     [type(t) for t in n2.tokens], name)
+                    self.assertEqual([type(t) for t in n.text],
+                                     [type(t) for t in n2.text], name)
+    def test_rejects_bad_data(self):
+        self.assertRaises(ValueError, parse.decode_trees, 'not a tree')
+
+if __name__ == '__main__':
+    unittest.main()